@@ -0,0 +1,32 @@
+#!/bin/bash
+#SBATCH --export=ALL
+#SBATCH -p queue
+#SBATCH --time=01:00:00
+#SBATCH --nodes=1
+#SBATCH --mem=50G
+#SBATCH --array=1-8
+#SBATCH --output=squire_%A_%a.log
+#SBATCH --error=squire_%A_%a.err
+#SBATCH --job-name=squire
+
+# Each task of the array creates the hdf5 file for a shard (a subset of the
+# chromosomes). Submit the final step once every task has finished with:
+#   sbatch --dependency=afterok:<array job id> merge_shards.sh
+# where merge_shards.sh runs:
+#   squire merge-shards --hdf5 squire.h5 shards/shard_*.h5
+#   squire reference --hdf5 squire.h5 reference_matrix.bed
+#   squire cpglist --hdf5 squire.h5 cpg_list.bed
+
+# Indexed (tabix) bgzipped bedmethyl files are the quickest to split between
+# shards. Each task writes its own list, as the tasks run at the same time
+BEDMETHYL_DIR="path/to/bedmethyls"
+BEDMETHYL_LIST="bedmethyl_list.${SLURM_ARRAY_TASK_ID}.txt"
+find "${BEDMETHYL_DIR}" -type f -name "*.bed.gz" -print0 | \
+    xargs -0 realpath | \
+    sort > \
+    "${BEDMETHYL_LIST}"
+
+squire create \
+    --hdf5 "shards/shard_${SLURM_ARRAY_TASK_ID}.h5" \
+    --file "${BEDMETHYL_LIST}" \
+    --shard "${SLURM_ARRAY_TASK_ID}/${SLURM_ARRAY_TASK_COUNT}"
@@ -0,0 +1,435 @@
+import gzip
+import io
+import mmap
+import re
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from squire.bgzf import (
+    find_index,
+    is_bgzf,
+    is_gzipped,
+    read_block_size,
+    read_index,
+    read_line_range,
+    scan_blocks,
+)
+from squire.squire_exceptions import BedMethylLineError, BedMethylReadError
+
+# Only 6 of the 18 bedmethyl fields are used by squire
+COLUMNS_TO_KEEP = [0, 1, 2, 3, 4, 11]
+NUMBER_OF_FIELDS = 18
+# Every field other than chrom, name, strand and color is a number
+INTEGER_FIELDS = [1, 2, 4, 6, 7, 9, 11, 12, 13, 14, 15, 16, 17]
+FLOAT_FIELDS = [10]  # fraction modified
+# Fields are separated by a single tab or space
+FIELD_SEPARATOR = re.compile(rb"[\t ]")
+
+# BGZF blocks hold at most 64KiB of uncompressed data
+BGZF_BLOCK_BYTES = 64 * 1024
+
+
+def split_into_byte_ranges(
+    file_path: Path, chunk_bytes: int
+) -> list[tuple[int, int]]:
+    """Split a file into (start, stop) byte ranges ending on line boundaries
+
+    Each range is roughly chunk_bytes long. The file is memory mapped, so
+    only the bytes around each boundary are actually read.
+    """
+    ranges = []
+    with (
+        open(file_path, "rb") as file,
+        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+    ):
+        size = len(mapped)
+        start = 0
+        while start < size:
+            newline = mapped.find(b"\n", min(start + chunk_bytes, size) - 1)
+            stop = size if newline == -1 else newline + 1
+            ranges.append((start, stop))
+            start = stop
+    return ranges
+
+
+@dataclass(frozen=True)
+class ByteRange:
+    """Lines between two byte offsets of an uncompressed bedmethyl file"""
+
+    file_path: Path
+    start: int
+    stop: int
+
+    def read(self) -> bytes:
+        with (
+            open(self.file_path, "rb") as file,
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+        ):
+            return mapped[self.start : self.stop]
+
+
+@dataclass(frozen=True)
+class BGZFRange:
+    """Lines starting within a range of blocks of a BGZF bedmethyl file
+
+    See `read_line_range` for how lines spanning blocks are handled. Ranges
+    that start a chromosome found using an index have that chromosome as
+    their region, as the number of lines before them is not known.
+    """
+
+    file_path: Path
+    start: int
+    stop: int
+    previous: int | None
+    skip: int = 0
+    region: str | None = None
+
+    def read(self) -> bytes:
+        return read_line_range(
+            self.file_path, self.start, self.stop, self.previous, self.skip
+        )
+
+
+@dataclass(frozen=True)
+class Lines:
+    """Lines that have already been read (e.g. from a gzip stream)"""
+
+    lines: bytes
+
+    def read(self) -> bytes:
+        return self.lines
+
+
+Chunk = ByteRange | BGZFRange | Lines
+
+
+def split_bgzf(
+    file_path: Path, chunk_bytes: int, chromosomes: list[str] | None
+) -> Iterator[tuple[Chunk, list[str] | None]]:
+    """Split a BGZF file into ranges of blocks
+
+    Each range holds roughly chunk_bytes of uncompressed data, and is
+    decompressed by the worker that parses it. If only some chromosomes are
+    wanted and the file has a tabix (.tbi) or CSI (.csi) index, only the
+    blocks that hold those chromosomes are read.
+
+    Yields each range with the chromosomes that should be kept from it.
+    """
+    blocks_per_chunk = max(1, chunk_bytes // BGZF_BLOCK_BYTES)
+    index_path = find_index(file_path)
+    with (
+        open(file_path, "rb") as file,
+        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+    ):
+        if chromosomes is None or index_path is None:
+            spans = [(0, len(mapped), 0, chromosomes)]
+        else:
+            index = read_index(index_path)
+            spans = []
+            for chromosome in chromosomes:
+                if chromosome not in index:
+                    continue
+                start, end = index[chromosome]
+                stop = end >> 16
+                if end & 0xFFFF:
+                    stop += read_block_size(mapped, stop) or 0
+                spans.append((start >> 16, stop, start & 0xFFFF, [chromosome]))
+            spans.sort(key=lambda span: (span[0], span[2]))
+
+        for start, stop, skip, keep in spans:
+            blocks = scan_blocks(mapped, start, stop)
+            for first in range(0, len(blocks), blocks_per_chunk):
+                last_offset, last_size = blocks[
+                    min(first + blocks_per_chunk, len(blocks)) - 1
+                ]
+                previous = blocks[first - 1][0] if first > 0 else None
+                yield (
+                    BGZFRange(
+                        file_path,
+                        blocks[first][0],
+                        last_offset + last_size,
+                        previous,
+                        skip if first == 0 else 0,
+                        keep[0] if first == 0 and keep and start else None,
+                    ),
+                    keep,
+                )
+
+
+def split_gzip(file_path: Path, chunk_bytes: int) -> Iterator[Lines]:
+    """Stream a (non BGZF) gzip file in chunks of lines
+
+    Plain gzip files can only be decompressed from the start, so this is done
+    serially (by the calling process) as the chunks are consumed.
+    """
+    with gzip.open(file_path, "rb") as file:
+        while lines := file.read(chunk_bytes):
+            yield Lines(lines + file.readline())
+
+
+def split_bedmethyl(
+    file_path: Path, chunk_bytes: int, chromosomes: list[str] | None = None
+) -> Iterator[tuple[Chunk, list[str] | None]]:
+    """Split a bedmethyl file into chunks of lines that can be parsed apart
+
+    Uncompressed, BGZF (bgzip) and gzip compressed files are supported. Only
+    BGZF files can be decompressed in parallel (and only indexed BGZF files
+    can skip chromosomes that are not wanted).
+
+    Yields each chunk with the chromosomes that should be kept from it (None
+    to keep every chromosome).
+    """
+    if not is_gzipped(file_path):
+        for start, stop in split_into_byte_ranges(file_path, chunk_bytes):
+            yield ByteRange(file_path, start, stop), chromosomes
+    elif is_bgzf(file_path):
+        yield from split_bgzf(file_path, chunk_bytes, chromosomes)
+    else:
+        for lines in split_gzip(file_path, chunk_bytes):
+            yield lines, chromosomes
+
+
+def count_chromosome_bytes(
+    lines: bytes | mmap.mmap, sizes: dict[str, int]
+) -> None:
+    """Add the number of bytes of each chromosome in some lines to sizes
+
+    Each chromosome is a contiguous block of lines, so the end of each block
+    is found with a binary search (only a few lines are looked at).
+    """
+
+    def line_start(offset: int) -> int:
+        # The start of the first line at or after offset
+        if offset == 0:
+            return 0
+        newline = lines.find(b"\n", offset - 1)
+        return len(lines) if newline == -1 else newline + 1
+
+    def chromosome_at(offset: int) -> bytes:
+        fields = lines[offset : offset + 256].split(None, 1)
+        return fields[0] if fields else b""
+
+    start = 0
+    while start < len(lines):
+        chromosome = chromosome_at(start)
+        low, high = start, len(lines)
+        while high - low > 1:
+            middle = (low + high) // 2
+            stop = line_start(middle)
+            if stop < len(lines) and chromosome_at(stop) == chromosome:
+                low = middle
+            else:
+                high = middle
+        stop = max(line_start(high), start + 1)
+        if chromosome:
+            name = chromosome.decode()
+            sizes[name] = sizes.get(name, 0) + stop - start
+        start = stop
+
+
+def get_chromosome_sizes(file_path: Path) -> dict[str, int]:
+    """Get the (approximate) number of bytes of each chromosome in a file
+
+    Uncompressed files are memory mapped (see `count_chromosome_bytes`).
+    Indexed BGZF files use the compressed size of each chromosome from the
+    index. Other compressed files have to be decompressed (serially).
+    """
+    sizes: dict[str, int] = {}
+    if not is_gzipped(file_path):
+        with (
+            open(file_path, "rb") as file,
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+        ):
+            count_chromosome_bytes(mapped, sizes)
+        return sizes
+    index_path = find_index(file_path) if is_bgzf(file_path) else None
+    if index_path is not None:
+        return {
+            chromosome: max(1, (end >> 16) - (start >> 16))
+            for chromosome, (start, end) in read_index(index_path).items()
+        }
+    for lines in split_gzip(file_path, 32 * 1024**2):
+        count_chromosome_bytes(lines.read(), sizes)
+    return sizes
+
+
+def find_malformed_line(lines: bytes) -> BedMethylLineError | None:
+    """Find the first malformed line in a chunk of a bedmethyl file
+
+    This is slow (line by line), so is only used to explain why a chunk
+    could not be parsed.
+    """
+    for line_number, line in enumerate(lines.splitlines()):
+        if not line.strip():
+            return BedMethylLineError(line_number, "line is blank")
+        fields = FIELD_SEPARATOR.split(line)
+        if b"" in fields:
+            return BedMethylLineError(
+                line_number,
+                "fields must be separated by a single tab or space",
+            )
+        if len(fields) != NUMBER_OF_FIELDS:
+            return BedMethylLineError(
+                line_number,
+                f"expected {NUMBER_OF_FIELDS} fields but found "
+                f"{len(fields)}. Ensure that it was created by ONT's modkit",
+            )
+        for field_number in sorted([*INTEGER_FIELDS, *FLOAT_FIELDS]):
+            is_float = field_number in FLOAT_FIELDS
+            try:
+                (float if is_float else int)(fields[field_number])
+            except ValueError:
+                return BedMethylLineError(
+                    line_number,
+                    f"field {field_number + 1} "
+                    f"({fields[field_number].decode(errors='replace')}) "
+                    f"is not {'a number' if is_float else 'an integer'}",
+                )
+    return None
+
+
+def parse_chunk(
+    chunk: Chunk, basename: str, chromosomes: list[str] | None = None
+) -> tuple[pd.DataFrame, int]:
+    """Parse (and validate) a chunk of a bedmethyl file
+
+    Only 6 columns are extracted from bedmethyl files:
+        - chromosome
+        - start
+        - end
+        - name(m/h)
+        - read depth
+        - number of modifications observed
+
+    The fraction modified is not parsed, it is derived from the read depth
+    and number of modifications when it is needed (see `format_percentages`).
+
+    Only the lines within the given chunk (see `split_bedmethyl`) are
+    parsed, so that a file can be parsed in chunks (and in parallel). If
+    chromosomes are given, only the lines for those chromosomes are kept.
+
+    Every line is validated as it is parsed: it must have 18 fields
+    separated by a single tab or space, the numeric fields must be integers
+    (or a number for the fraction modified), start must not be negative and
+    must be less than end, and counts must not be negative. Blank lines are
+    not allowed. The numeric fields that squire doesn't use are parsed and
+    then discarded.
+    Parsing the last field catches lines with too few fields, the total
+    number of separators is counted, which catches lines with too many (or
+    doubled separators), and the number of lines is counted, which catches
+    blank lines (that pandas skips). The integer fields are parsed without
+    a dtype, as pandas would convert integral floats (such as 2.0 or 1e3)
+    to the dtype. Sort order is checked by `SampleWriter`.
+
+    Returns the parsed chunk (indexed by line number within the chunk) and
+    the number of lines in the chunk.
+
+    Raises
+    ---
+    BedMethylLineError
+        If a line of the chunk is malformed.
+    """
+    column_names = [
+        "chr",
+        "start",
+        "end",
+        "name",
+        f"{basename}_read_depth",
+        f"{basename}_modifications",
+    ]
+    column_dtypes = {
+        "chr": str,
+        "start": int,
+        "end": int,
+        "name": str,
+        f"{basename}_read_depth": int,
+        f"{basename}_modifications": int,
+    }
+    lines = chunk.read()
+    if not lines:
+        return (
+            pd.DataFrame(
+                columns=column_names  # type: ignore[arg-type]
+            ).astype(column_dtypes),
+            0,
+        )
+    # The unused numeric fields are read to check their types
+    field_names = [
+        column_names[COLUMNS_TO_KEEP.index(number)]
+        if number in COLUMNS_TO_KEEP
+        else f"field_{number}"
+        for number in range(NUMBER_OF_FIELDS)
+    ]
+    try:
+        bedmethyl = pd.read_csv(
+            io.BytesIO(lines),
+            sep=r"\s+",  # bedmethyl has mix of tabs and spaces for separators
+            header=None,
+            usecols=sorted(  # type: ignore[arg-type]
+                {*COLUMNS_TO_KEEP, *INTEGER_FIELDS, *FLOAT_FIELDS}
+            ),
+            names=field_names,
+            dtype={
+                "chr": str,
+                "name": str,
+                **{f"field_{number}": float for number in FLOAT_FIELDS},
+            },  # type: ignore[arg-type]
+        )
+        integer_fields = [
+            field_names[number] for number in sorted(INTEGER_FIELDS)
+        ]
+        # Any token that isn't an integer gives a column of another dtype
+        if not (bedmethyl[integer_fields].dtypes == np.int64).all():
+            raise ValueError("Integer fields contain other values")
+    except (ValueError, pd.errors.ParserError) as e:
+        error = find_malformed_line(lines)
+        if error is None:
+            raise BedMethylReadError(
+                f"Type conversion failed. File may contain invalid values "
+                f"for expected types.\nError: {str(e)}"
+            ) from e
+        raise error from e
+
+    # Fields are separated by a single tab or space in modkit's output, and
+    # lines are never blank, if this isn't the case the slow check is used
+    separators = lines.count(b"\t") + lines.count(b" ")
+    line_count = lines.count(b"\n") + (not lines.endswith(b"\n"))
+    if (
+        separators != (NUMBER_OF_FIELDS - 1) * len(bedmethyl)
+        or line_count != len(bedmethyl)
+    ):
+        error = find_malformed_line(lines)
+        if error is not None:
+            raise error
+    negative_starts = (bedmethyl["start"] < 0).to_numpy()
+    if negative_starts.any():
+        line_number = int(np.argmax(negative_starts))
+        raise BedMethylLineError(
+            line_number,
+            f"start ({bedmethyl['start'].iat[line_number]}) can't be negative",
+        )
+    invalid_ranges = (bedmethyl["start"] >= bedmethyl["end"]).to_numpy()
+    if invalid_ranges.any():
+        line_number = int(np.argmax(invalid_ranges))
+        raise BedMethylLineError(
+            line_number,
+            f"start ({bedmethyl['start'].iat[line_number]}) is not less "
+            f"than end ({bedmethyl['end'].iat[line_number]})",
+        )
+    count_columns = [f"{basename}_read_depth", f"{basename}_modifications"]
+    negative_counts = (bedmethyl[count_columns] < 0).any(axis=1).to_numpy()
+    if negative_counts.any():
+        raise BedMethylLineError(
+            int(np.argmax(negative_counts)),
+            "read depth and number of modifications can't be negative",
+        )
+
+    bedmethyl = bedmethyl[column_names]
+    number_of_lines = len(bedmethyl)
+    if chromosomes is not None:
+        bedmethyl = bedmethyl[bedmethyl["chr"].isin(chromosomes)]
+    return bedmethyl, number_of_lines
@@ -0,0 +1,453 @@
+import gzip
+import mmap
+import struct
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Literal
+
+import numpy as np
+import numpy.typing as npt
+
+GZIP_MAGIC = b"\x1f\x8b"
+BGZF_HEADER_SIZE = 18
+BGZF_FOOTER_SIZE = 8
+# The most data bgzip puts in a block, so that even incompressible data fits
+# in the 64KiB that a block can be
+BGZF_BLOCK_DATA = 0xFF00
+BGZF_EOF = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+TABIX_PSEUDO_BIN = 37450
+# Tabix bins are 16KiB (2^14) at the lowest of 5 levels, the linear index
+# has an entry for each of these windows
+TABIX_MIN_SHIFT = 14
+TABIX_DEPTH = 5
+# Preset for BED files: 0-based half open (UCSC) coordinates in columns 1-3,
+# lines starting with # are skipped
+TABIX_BED_PRESET = (0x10000, 1, 2, 3, ord("#"), 0)
+
+
+def is_gzipped(file_path: Path) -> bool:
+    """Checks if a file is gzip compressed (this includes BGZF)"""
+    with open(file_path, "rb") as file:
+        return file.read(2) == GZIP_MAGIC
+
+
+def read_block_size(mapped: mmap.mmap, offset: int) -> int | None:
+    """Read the (compressed) size of the BGZF block starting at offset
+
+    Returns None if there is not a BGZF block header at offset. BGZF blocks
+    are gzip members with a 'BC' extra subfield holding the block size.
+    """
+    header = mapped[offset : offset + BGZF_HEADER_SIZE]
+    if (
+        len(header) < BGZF_HEADER_SIZE
+        or header[:4] != b"\x1f\x8b\x08\x04"
+        or header[12:14] != b"BC"
+    ):
+        return None
+    (block_size_minus_one,) = struct.unpack("<H", header[16:18])
+    return block_size_minus_one + 1
+
+
+def is_bgzf(file_path: Path) -> bool:
+    """Checks if a file is BGZF compressed (e.g. by bgzip)
+
+    BGZF files are valid gzip files that are made up of independently
+    compressed blocks, allowing them to be decompressed in parallel.
+    """
+    with (
+        open(file_path, "rb") as file,
+        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+    ):
+        return read_block_size(mapped, 0) is not None
+
+
+def scan_blocks(
+    mapped: mmap.mmap, start: int = 0, stop: int | None = None
+) -> list[tuple[int, int]]:
+    """Find the (offset, size) of each non-empty BGZF block in [start, stop)
+
+    Only block headers and footers are read, not the compressed data.
+    """
+    stop = len(mapped) if stop is None else min(stop, len(mapped))
+    blocks = []
+    offset = start
+    while offset < stop:
+        block_size = read_block_size(mapped, offset)
+        if block_size is None:
+            raise ValueError(f"No BGZF block found at byte {offset}")
+        (uncompressed_size,) = struct.unpack(
+            "<I", mapped[offset + block_size - 4 : offset + block_size]
+        )
+        if uncompressed_size > 0:
+            blocks.append((offset, block_size))
+        offset += block_size
+    return blocks
+
+
+def decompress_blocks(mapped: mmap.mmap, start: int, stop: int) -> bytes:
+    """Decompress the BGZF blocks between the compressed offsets start/stop"""
+    return gzip.decompress(mapped[start:stop])
+
+
+def read_line_range(
+    file_path: Path, start: int, stop: int, previous: int | None, skip: int
+) -> bytes:
+    """Read the lines that start within a range of BGZF blocks
+
+    The blocks in [start, stop) are decompressed, and the following blocks
+    are read until the last line is complete. The first (partial) line is
+    dropped if it started in an earlier block; this is checked using the
+    block at `previous`. If `previous` is None, the first `skip` bytes are
+    dropped instead (e.g. the offset of a chromosome from a tabix index).
+    """
+    with (
+        open(file_path, "rb") as file,
+        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+    ):
+        lines = decompress_blocks(mapped, start, stop)
+        if previous is None:
+            lines = lines[skip:]
+        elif not decompress_blocks(mapped, previous, start).endswith(b"\n"):
+            first_newline = lines.find(b"\n")
+            if first_newline == -1:
+                return b""
+            lines = lines[first_newline + 1 :]
+
+        offset = stop
+        while lines and not lines.endswith(b"\n") and offset < len(mapped):
+            block_size = read_block_size(mapped, offset)
+            if block_size is None:
+                break
+            block = decompress_blocks(mapped, offset, offset + block_size)
+            newline = block.find(b"\n")
+            if newline != -1:
+                return lines + block[: newline + 1]
+            lines += block
+            offset += block_size
+        return lines
+
+
+def find_index(file_path: Path) -> Path | None:
+    """Find a tabix (.tbi) or CSI (.csi) index next to a BGZF file"""
+    for suffix in (".tbi", ".csi"):
+        index_path = file_path.with_name(file_path.name + suffix)
+        if index_path.exists():
+            return index_path
+    return None
+
+
+def parse_names(data: bytes, offset: int) -> tuple[list[str], int]:
+    """Parse the tabix header (up to and including sequence names)"""
+    (names_length,) = struct.unpack_from("<i", data, offset + 24)
+    names_start = offset + 28
+    names = data[names_start : names_start + names_length]
+    return (
+        [name.decode() for name in names.split(b"\x00") if name],
+        names_start + names_length,
+    )
+
+
+def read_index(index_path: Path) -> dict[str, tuple[int, int]]:
+    """Read the span of each chromosome from a tabix or CSI index
+
+    Returns the virtual offsets (compressed offset << 16 | offset within the
+    decompressed block) that each chromosome's lines start and end at.
+    """
+    data = gzip.decompress(index_path.read_bytes())
+    magic = data[:4]
+    if magic == b"TBI\x01":
+        (n_references,) = struct.unpack_from("<i", data, 4)
+        names, offset = parse_names(data, 8)
+        pseudo_bin = TABIX_PSEUDO_BIN
+        has_loffset = False
+    elif magic == b"CSI\x01":
+        _, depth, aux_length = struct.unpack_from("<iii", data, 4)
+        names, _ = parse_names(data, 16) if aux_length >= 28 else ([], 0)
+        offset = 16 + aux_length
+        (n_references,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+        has_loffset = True
+    else:
+        raise ValueError(f"{index_path} is not a tabix or CSI index")
+
+    if len(names) != n_references:
+        raise ValueError(f"{index_path} does not contain sequence names")
+
+    spans = {}
+    for name in names:
+        (n_bins,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        span_start, span_end = None, None
+        for _ in range(n_bins):
+            (bin_number,) = struct.unpack_from("<I", data, offset)
+            offset += 12 if has_loffset else 4
+            (n_chunks,) = struct.unpack_from("<i", data, offset)
+            offset += 4
+            chunks = struct.unpack_from(f"<{2 * n_chunks}Q", data, offset)
+            offset += 16 * n_chunks
+            if bin_number == pseudo_bin:
+                continue
+            for chunk_start, chunk_end in zip(
+                chunks[::2], chunks[1::2], strict=True
+            ):
+                if span_start is None or chunk_start < span_start:
+                    span_start = chunk_start
+                if span_end is None or chunk_end > span_end:
+                    span_end = chunk_end
+        if not has_loffset:
+            (n_intervals,) = struct.unpack_from("<i", data, offset)
+            offset += 4 + 8 * n_intervals
+        if span_start is not None and span_end is not None:
+            spans[name] = (span_start, span_end)
+    return spans
+
+
+def compress_block(data: bytes, level: int = 6) -> bytes:
+    """Compress up to BGZF_BLOCK_DATA bytes into a single BGZF block"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER_SIZE + len(compressed) + BGZF_FOOTER_SIZE
+    return (
+        b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+        + struct.pack("<H", block_size - 1)
+        + compressed
+        + struct.pack("<II", zlib.crc32(data), len(data))
+    )
+
+
+@dataclass
+class BgzfChunk:
+    """Lines of a chromosome compressed into BGZF blocks
+
+    Attributes
+    ---
+    data: bytes
+        The compressed blocks.
+    block_sizes: list[tuple[int, int]]
+        The compressed and uncompressed size of each block.
+    chromosome: str
+        The chromosome of the lines.
+    starts/ends: npt.NDArray[np.int64]
+        The (0-based, half open) interval of each line.
+    line_ends: npt.NDArray[np.int64]
+        The (uncompressed) offset of the end of each line in the chunk.
+    """
+
+    data: bytes
+    block_sizes: list[tuple[int, int]]
+    chromosome: str
+    starts: npt.NDArray[np.int64]
+    ends: npt.NDArray[np.int64]
+    line_ends: npt.NDArray[np.int64]
+
+
+def compress_lines(
+    lines: bytes,
+    chromosome: str,
+    starts: npt.ArrayLike,
+    ends: npt.ArrayLike,
+    level: int = 6,
+) -> BgzfChunk:
+    """Compress lines of a chromosome into BGZF blocks
+
+    Chunks are compressed independently of each other (e.g. by different
+    workers), and are concatenated by `BgzfWriter`.
+    """
+    blocks = [
+        compress_block(lines[offset : offset + BGZF_BLOCK_DATA], level)
+        for offset in range(0, len(lines), BGZF_BLOCK_DATA)
+    ]
+    return BgzfChunk(
+        b"".join(blocks),
+        [
+            (len(block), min(BGZF_BLOCK_DATA, len(lines) - offset))
+            for block, offset in zip(
+                blocks, range(0, len(lines), BGZF_BLOCK_DATA), strict=True
+            )
+        ],
+        chromosome,
+        np.asarray(starts, dtype=np.int64),
+        np.asarray(ends, dtype=np.int64),
+        np.flatnonzero(np.frombuffer(lines, dtype=np.uint8) == ord("\n")) + 1,
+    )
+
+
+def region_to_bin(
+    starts: npt.NDArray[np.int64], ends: npt.NDArray[np.int64]
+) -> npt.NDArray[np.int64]:
+    """The smallest tabix bin that contains each interval (as reg2bin)"""
+    lasts = ends - 1
+    bins = np.zeros(len(starts), dtype=np.int64)
+    unbinned = np.ones(len(starts), dtype=bool)
+    for level in range(TABIX_DEPTH, 0, -1):
+        shift = TABIX_MIN_SHIFT + 3 * (TABIX_DEPTH - level)
+        fits = unbinned & ((starts >> shift) == (lasts >> shift))
+        bins[fits] = ((1 << (3 * level)) - 1) // 7 + (starts[fits] >> shift)
+        unbinned &= ~fits
+    return bins
+
+
+@dataclass
+class ChromosomeIndex:
+    """The tabix bins and linear index of a chromosome
+
+    Attributes
+    ---
+    bins: dict[int, list[list[int]]]
+        The [start, end) virtual offsets of the chunks of lines in each bin.
+    linear: npt.NDArray[np.uint64]
+        The smallest virtual offset of the lines overlapping each window.
+    """
+
+    bins: dict[int, list[list[int]]]
+    linear: npt.NDArray[np.uint64]
+
+    def add(
+        self,
+        starts: npt.NDArray[np.int64],
+        ends: npt.NDArray[np.int64],
+        line_starts: npt.NDArray[np.uint64],
+        line_ends: npt.NDArray[np.uint64],
+    ) -> None:
+        """Add lines (in the order they are in the file) to the index"""
+        bins = region_to_bin(starts, ends)
+        # Consecutive lines in the same bin are a single chunk
+        run_starts = np.flatnonzero(np.diff(bins, prepend=-1))
+        run_ends = np.append(run_starts[1:], len(bins)) - 1
+        for bin_number, chunk_start, chunk_end in zip(
+            bins[run_starts].tolist(),
+            line_starts[run_starts].tolist(),
+            line_ends[run_ends].tolist(),
+            strict=True,
+        ):
+            chunks = self.bins.setdefault(bin_number, [])
+            if chunks and chunks[-1][1] == chunk_start:
+                chunks[-1][1] = chunk_end
+            else:
+                chunks.append([chunk_start, chunk_end])
+
+        first_windows = starts >> TABIX_MIN_SHIFT
+        last_windows = (np.maximum(ends, starts + 1) - 1) >> TABIX_MIN_SHIFT
+        if last_windows.max() >= len(self.linear):
+            self.linear = np.concatenate(
+                [
+                    self.linear,
+                    np.full(
+                        last_windows.max() + 1 - len(self.linear),
+                        np.iinfo(np.uint64).max,
+                        dtype=np.uint64,
+                    ),
+                ]
+            )
+        for step in range(int((last_windows - first_windows).max()) + 1):
+            overlaps = first_windows + step <= last_windows
+            np.minimum.at(
+                self.linear,
+                first_windows[overlaps] + step,
+                line_starts[overlaps],
+            )
+
+    def to_bytes(self) -> bytes:
+        """The index of the chromosome, as stored in a tabix (.tbi) file"""
+        parts = [struct.pack("<i", len(self.bins))]
+        for bin_number, chunks in sorted(self.bins.items()):
+            parts.append(struct.pack("<Ii", bin_number, len(chunks)))
+            parts.append(struct.pack(f"<{2 * len(chunks)}Q", *sum(chunks, [])))
+        # Windows without lines are given the offset of the window before
+        linear = self.linear.copy()
+        empty = linear == np.iinfo(np.uint64).max
+        linear[empty] = 0
+        linear = np.maximum.accumulate(linear)
+        parts.append(struct.pack("<i", len(linear)))
+        parts.append(linear.astype("<u8").tobytes())
+        return b"".join(parts)
+
+
+class BgzfWriter:
+    """Writes chunks of lines to a BGZF file, and builds a tabix index
+
+    The file can be read by anything that reads gzip (or bgzip) files, and
+    the index is tabix-compatible (a .tbi index with the BED preset, as from
+    `tabix -p bed`), so regions can be read with tabix. Its bytes can differ
+    from the index that tabix would create. Chunks must be written in
+    genomic order.
+    """
+
+    def __init__(self, out_file: BinaryIO, index_path: Path) -> None:
+        self.out_file = out_file
+        self.index_path = index_path
+        self.offset = 0
+        self.indexes: dict[str, ChromosomeIndex] = {}
+
+    def write(self, chunk: BgzfChunk) -> None:
+        """Write a chunk of compressed lines, adding its lines to the index"""
+        if len(chunk.line_ends) > 0:
+            compressed_offsets = self.offset + np.cumsum(
+                [0] + [compressed for compressed, _ in chunk.block_sizes]
+            )
+            block_starts = np.cumsum(
+                [0] + [uncompressed for _, uncompressed in chunk.block_sizes]
+            )
+            line_starts = np.concatenate([[0], chunk.line_ends[:-1]])
+            self.indexes.setdefault(
+                chunk.chromosome,
+                ChromosomeIndex({}, np.empty(0, dtype=np.uint64)),
+            ).add(
+                chunk.starts,
+                chunk.ends,
+                to_virtual_offsets(
+                    line_starts, block_starts, compressed_offsets, "right"
+                ),
+                to_virtual_offsets(
+                    chunk.line_ends, block_starts, compressed_offsets, "left"
+                ),
+            )
+        self.out_file.write(chunk.data)
+        self.offset += len(chunk.data)
+
+    def finish(self) -> None:
+        """End the file with an empty block and write the index"""
+        self.out_file.write(BGZF_EOF)
+        names = b"".join(
+            chromosome.encode() + b"\x00" for chromosome in self.indexes
+        )
+        index = b"".join(
+            [
+                b"TBI\x01",
+                struct.pack(
+                    "<8i", len(self.indexes), *TABIX_BED_PRESET, len(names)
+                ),
+                names,
+                *(index.to_bytes() for index in self.indexes.values()),
+            ]
+        )
+        with open(self.index_path, "wb") as index_file:
+            for offset in range(0, len(index), BGZF_BLOCK_DATA):
+                index_file.write(
+                    compress_block(index[offset : offset + BGZF_BLOCK_DATA])
+                )
+            index_file.write(BGZF_EOF)
+
+
+def to_virtual_offsets(
+    offsets: npt.NDArray[np.int64],
+    block_starts: npt.NDArray[np.int64],
+    compressed_offsets: npt.NDArray[np.int64],
+    side: Literal["left", "right"],
+) -> npt.NDArray[np.uint64]:
+    """Convert offsets in the uncompressed data into virtual offsets
+
+    A virtual offset is the compressed offset of a block << 16 | the offset
+    within that block. Offsets on the boundary between two blocks are at
+    the start of the block after (side="right") or at the end of the block
+    before (side="left").
+    """
+    blocks = np.searchsorted(block_starts, offsets, side=side) - 1
+    blocks = np.clip(blocks, 0, len(block_starts) - 2)
+    return (compressed_offsets[blocks].astype(np.uint64) << np.uint64(16)) | (
+        offsets - block_starts[blocks]
+    ).astype(np.uint64)
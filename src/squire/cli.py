@@ -6,11 +6,14 @@ from typing import LiteralString
 
 from squire.main import (
     add_to_hdf,
+    compute_stats,
     create_hdf,
+    merge_shard_files,
     print_threshold_analysis,
     write_cpg_list,
     write_reference_matrix,
 )
+from squire.parallel import available_cpus
 from squire.squire_exceptions import SquireError
 from squire.types import (
     SquireArgs,
@@ -79,6 +82,38 @@ def file_list(string: str) -> list[Path]:
     return [Path(file) for file in string.split(",")]
 
 
+def string_list(string: str) -> list[str]:
+    """Convert a comma separated string into a list of strings"""
+    return string.split(",")
+
+
+def positive_int(string: str) -> int:
+    """Convert a string into a strictly positive integer"""
+    try:
+        number = int(string)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"{string} is not an integer") from e
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{string} is not positive")
+    return number
+
+
+def shard_number(string: str) -> tuple[int, int]:
+    """Convert a string of the form i/N into a shard number and count"""
+    try:
+        shard, shard_count = (int(number) for number in string.split("/"))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(
+            f"{string} is not of the form i/N (e.g. 1/4)"
+        ) from e
+    if not 1 <= shard <= shard_count:
+        raise argparse.ArgumentTypeError(
+            f"{string} is not a shard between 1/{shard_count} and "
+            f"{shard_count}/{shard_count}"
+        )
+    return shard, shard_count
+
+
 def float_list(string: str) -> list[float]:
     """Convert a comma separated string into a list of floats"""
     try:
@@ -158,28 +193,127 @@ def main() -> None:
         ),
         type=Path,
     )
+    parser_hdf.add_argument(
+        "-c",
+        "--chromosomes",
+        help=(
+            "Comma separated list of chromosomes to use "
+            "(e.g. chr1,chr2,chrX). Indexed (tabix) bgzipped bedmethyl "
+            "files will only have these chromosomes read"
+        ),
+        type=string_list,
+    )
 
-    subparsers.add_parser(
+    parser_performance = argparse.ArgumentParser(add_help=False)
+    performance_group = parser_performance.add_argument_group(
+        "performance options"
+    )
+    performance_group.add_argument(
+        "-j",
+        "--jobs",
+        help=(
+            "Number of workers to use. Defaults to the number of CPUs "
+            "allocated to squire (e.g. by a job scheduler)"
+        ),
+        default=available_cpus(),
+        type=positive_int,
+    )
+    performance_group.add_argument(
+        "--backend",
+        help=(
+            "Whether workers are processes or threads. Threads avoid "
+            "copying data between workers"
+        ),
+        choices=["process", "thread"],
+        default="process",
+    )
+    performance_group.add_argument(
+        "--chunk-size",
+        help="Number of genomic loci processed at a time",
+        default=100_000,
+        type=positive_int,
+    )
+
+    parser_create = subparsers.add_parser(
         "create",
         help="Initialise the hdf5 file containing all data",
-        parents=[shared_parser, parser_hdf],
+        parents=[shared_parser, parser_hdf, parser_performance],
         formatter_class=SquireSubparserHelpFormatter,
     )
+    parser_create.add_argument(
+        "--shard",
+        help=(
+            "Only process shard i of N (e.g. 1/4). Chromosomes are split "
+            "between N shards with roughly the same amount of data in each. "
+            "Shards can be run as separate jobs (e.g. an array job) and "
+            "combined with squire merge-shards"
+        ),
+        type=shard_number,
+    )
 
     subparsers.add_parser(
         "add",
         help="Add to a hdf5 file with additional bedmethyl files",
-        parents=[shared_parser, parser_hdf],
+        parents=[shared_parser, parser_hdf, parser_performance],
         formatter_class=SquireSubparserHelpFormatter,
     )
 
     # -------------
-    # REFERENCE
+    # REFERENCE/CPGLIST/REPORT
     # -------------
+    parser_regions = argparse.ArgumentParser(add_help=False)
+    region_group = parser_regions.add_argument_group("region options")
+    region_group.add_argument(
+        "-r",
+        "--regions",
+        help=(
+            "Path to a BED file of regions, only loci that overlap these "
+            "regions are used (e.g. ./panel.bed)"
+        ),
+        type=Path,
+    )
+    region_group.add_argument(
+        "-c",
+        "--chromosomes",
+        help=(
+            "Comma separated list of chromosomes to use (e.g. chr1,chr2,chrX)"
+        ),
+        type=string_list,
+    )
+
+    parser_samples = argparse.ArgumentParser(add_help=False)
+    parser_samples.add_argument(
+        "-s",
+        "--samples",
+        help=(
+            "Comma separated list of samples to use (e.g. neuron,glia). "
+            "P-values for a subset of the samples are computed with "
+            "squire stats --samples"
+        ),
+        type=string_list,
+    )
+
+    parser_output = argparse.ArgumentParser(add_help=False)
+    parser_output.add_argument(
+        "-z",
+        "--bgzip",
+        action="store_true",
+        help=(
+            "Compress the output with BGZF (as bgzip) and write a tabix "
+            "index alongside it (<out_path>.tbi)"
+        ),
+    )
+
     parser_reference = subparsers.add_parser(
         "reference",
         help="Generate the reference matrix from existing hdf5 file",
-        parents=[shared_parser],
+        parents=[
+            shared_parser,
+            parser_samples,
+            parser_output,
+            parser_regions,
+            parser_performance,
+        ],
         formatter_class=SquireSubparserHelpFormatter,
     )
     parser_reference.add_argument(
@@ -191,29 +325,49 @@ def main() -> None:
         type=Path,
     )
 
-    # -------------
-    # CPGLIST
-    # -------------
     parser_cpglist = subparsers.add_parser(
         "cpglist",
         help=(
             "Generate a CpG list containing only CpGs that are significantly "
             "different between cell types"
         ),
-        parents=[shared_parser],
+        parents=[
+            shared_parser,
+            parser_samples,
+            parser_output,
+            parser_regions,
+        ],
         formatter_class=SquireSubparserHelpFormatter,
     )
     parser_cpglist.add_argument(
-        "out_path",
-        help="File path to write the CpG list to (e.g. ./cpg_list.bed)",
+        "out_paths",
+        help=(
+            "File path to write the CpG list to (e.g. ./cpg_list.bed). Give "
+            "one path for each threshold to write several CpG lists at once"
+        ),
+        metavar="out_path",
+        nargs="+",
         type=Path,
     )
-    parser_cpglist.add_argument(
+    filter_group = parser_cpglist.add_mutually_exclusive_group()
+    filter_group.add_argument(
         "-t",
-        "--threshold",
-        help="The threshold to use when filtering",
-        default=1e-10,
-        type=float,
+        "--thresholds",
+        help=(
+            "The threshold to use when filtering, or a comma separated list "
+            "of thresholds (one for each out_path, e.g. 1e-5,1e-10)"
+        ),
+        default=[1e-10],
+        type=float_list,
+    )
+    filter_group.add_argument(
+        "-n",
+        "--top",
+        help=(
+            "Instead of using a threshold, keep the N CpGs with the smallest "
+            "p-values (ties are broken by genomic position)"
+        ),
+        type=positive_int,
     )
 
     # -------------
@@ -222,7 +376,7 @@ def main() -> None:
     parser_report = subparsers.add_parser(
         "report",
         help="Reports CpG list length for different threshold values",
-        parents=[shared_parser],
+        parents=[shared_parser, parser_samples, parser_regions],
         formatter_class=SquireSubparserHelpFormatter,
     )
     parser_report.add_argument(
@@ -242,6 +396,35 @@ def main() -> None:
         action="store_true",
     )
 
+    # -------------
+    # STATS
+    # -------------
+    subparsers.add_parser(
+        "stats",
+        help=(
+            "Compute the p-values again, or compute p-values for a subset of "
+            "the samples (with --samples)"
+        ),
+        parents=[shared_parser, parser_samples, parser_performance],
+        formatter_class=SquireSubparserHelpFormatter,
+    )
+
+    # -------------
+    # MERGE-SHARDS
+    # -------------
+    parser_merge_shards = subparsers.add_parser(
+        "merge-shards",
+        help="Combine hdf5 files created with squire create --shard",
+        parents=[shared_parser],
+        formatter_class=SquireSubparserHelpFormatter,
+    )
+    parser_merge_shards.add_argument(
+        "shards",
+        help="The hdf5 files of every shard (e.g. shard_*.h5)",
+        nargs="+",
+        type=Path,
+    )
+
     args = parser.parse_args()
     typed_args = convert_to_squire_args(args)
     run_squire(typed_args)
@@ -253,6 +436,8 @@ COMMAND_MAP = {
     "reference": write_reference_matrix,
     "cpglist": write_cpg_list,
     "report": print_threshold_analysis,
+    "stats": compute_stats,
+    "merge-shards": merge_shard_files,
 }
 
 
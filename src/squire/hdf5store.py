@@ -1,152 +1,1534 @@
+import bisect
 import os
+import tempfile
+import warnings
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
 from pathlib import Path
 
+import numpy as np
+import numpy.typing as npt
 import pandas as pd
+import tables
+from tables.attributeset import AttributeSet
 
-from squire.sorting import chromosome_sorter
+from squire.bedmethyl import (
+    BGZFRange,
+    Chunk,
+    get_chromosome_sizes,
+    parse_chunk,
+    split_bedmethyl,
+)
+from squire.parallel import WorkerPool, ordered_imap
+from squire.sorting import (
+    MAX_SPAN,
+    chromosome_sorter,
+    key_starts,
+    pack_loci,
+    unpack_loci,
+)
+from squire.squire_exceptions import (
+    BedMethylLineError,
+    BedMethylReadError,
+    HDFReadError,
+)
+from squire.types import RowRanges
+
+# The merged data is partitioned by chromosome (merged/<chromosome>). Each
+# partition is a table of loci (coordinates) and a table for each sample (in
+# merged/<chromosome>/samples), all aligned by row. The p-values of each
+# partition are in stats/<chromosome>, also aligned by row. Tables are
+# indexed by their row number within the partition. P-values computed
+# against a subset of the samples are in subset_stats/<samples>/<chromosome>
+MERGED_GROUP = "merged"
+# The version of this layout is stored in the attributes of the merged group
+# (see `validate_hdf5`), along with the SQUIRE release of each version
+LAYOUT_VERSION = 2
+LAYOUT_RELEASES = {1: "0.1.x", 2: "0.2.x"}
+STATS_GROUP = "stats"
+SUBSET_STATS_GROUP = "subset_stats"
+# Every p-value (of every chromosome) in ascending order, see `report`
+SORTED_P_VALUES_KEY = "sorted_p_values"
+COORDINATE_COLUMNS = ["chr", "start", "end", "name"]
+# Fraction modified is derived from the counts (see `format_percentages`)
+SAMPLE_FIELDS = ["read_depth", "modifications"]
+# Compression for every table, blosc is fast enough that reading compressed
+# tables is quicker than reading uncompressed ones (from slow storage)
+COMPRESSION = {"complib": "blosc:zstd", "complevel": 5}
+
+# Chromosomes are used as node names, which are often not valid python
+# identifiers (chr1_KI270706v1_random). Nodes are never accessed as
+# attributes, so this doesn't matter.
+warnings.filterwarnings("ignore", category=tables.NaturalNameWarning)
 
 
 def get_file_basename(file_path: Path) -> str:
-    """Get the basename of a file for organisational purposes"""
-    return os.path.splitext(os.path.basename(file_path))[0]
+    """Get the basename of a file for organisational purposes
+
+    Compression extensions are removed first (sample.bed.gz -> sample).
+    """
+    basename = os.path.basename(file_path)
+    for extension in (".gz", ".bgz"):
+        basename = basename.removesuffix(extension)
+    return os.path.splitext(basename)[0]
+
 
+def get_coordinates_key(chromosome: str, group: str = MERGED_GROUP) -> str:
+    """Get the key of the table holding a chromosome's merged loci"""
+    return f"{group}/{chromosome}/coordinates"
 
-def add_file_to_hdf_store(file_path: Path, hdf_path: Path) -> None:
-    """Add bedmethyl data to a hdf5 store
 
-    Only 6 columns are extracted from bedmethyl files:
-        - chromosome
-        - start
-        - end
-        - name(m/h)
-        - read depth
-        - number of modifications observed
+def get_sample_key(
+    sample: str, chromosome: str, group: str = MERGED_GROUP
+) -> str:
+    """Get the key of the table holding a sample's data for a chromosome"""
+    return f"{group}/{chromosome}/samples/{sample}"
 
-    For each genomic loci, the fraction modified is calculated as well.
-    Although this value exists in the bedmethyl file, calculating this value
-    instead of reading (and parsing) the field will be as fast if not faster.
 
-    Files are read and parsed in chunks to save on memory.
+def get_stats_key(chromosome: str, group: str = STATS_GROUP) -> str:
+    """Get the key of the table holding a chromosome's p-values"""
+    return f"{group}/{chromosome}"
+
+
+def get_stats_group(
+    store: pd.HDFStore, samples: list[str] | None = None
+) -> str:
+    """Get the group of the p-values computed against samples
+
+    P-values computed against every sample (samples is None) are in the
+    stats group. Those of a subset of the samples (see `squire stats`) are
+    in a group named after the subset.
     """
-    mode_to_use = "w" if not os.path.exists(hdf_path) else "a"
-    columns_to_keep = [0, 1, 2, 3, 4, 11]
-    basename = get_file_basename(file_path)
-    column_names = [
-        "chr",
-        "start",
-        "end",
-        "name",
-        f"{basename}_read_depth",
-        f"{basename}_modifications",
+    if samples is None or set(samples) == set(get_sample_names(store)):
+        return STATS_GROUP
+    return f"{SUBSET_STATS_GROUP}/{'+'.join(sorted(samples))}"
+
+
+def get_sorted_p_values_key(group: str = STATS_GROUP) -> str:
+    """Get the key of the sorted p-values of a stats group"""
+    if group == STATS_GROUP:
+        return SORTED_P_VALUES_KEY
+    return f"{group}/{SORTED_P_VALUES_KEY}"
+
+
+def get_attributes(store: pd.HDFStore, group: str) -> AttributeSet:
+    """Get the attributes of a group (merged or stats) of the store"""
+    return store.get_node(group)._v_attrs  # type: ignore[union-attr]
+
+
+def get_table(store: pd.HDFStore, key: str) -> tables.Table:
+    """Get the PyTables table of a table in the store
+
+    Rows and columns of the table can be read (and modified) directly,
+    without building a dataframe.
+    """
+    return store.get_storer(key).table  # type: ignore[attr-defined]
+
+
+def get_sample_names(store: pd.HDFStore) -> list[str]:
+    """Get the names of the samples in the merged data
+
+    Samples are in the order that they were added.
+    """
+    return list(get_attributes(store, MERGED_GROUP).samples)
+
+
+def select_samples(
+    store: pd.HDFStore, samples: list[str] | None = None
+) -> list[str]:
+    """Check that samples are in the merged data (all samples if None)"""
+    if samples is None:
+        return get_sample_names(store)
+    for sample in samples:
+        if sample not in get_sample_names(store):
+            raise HDFReadError(
+                f"{sample} is not a sample in the hdf5 file. The samples are "
+                f"{','.join(get_sample_names(store))}."
+            )
+    if len(set(samples)) != len(samples):
+        raise HDFReadError(f"Samples are given more than once: {samples}.")
+    return samples
+
+
+def get_chromosomes(store: pd.HDFStore) -> list[str]:
+    """Get the chromosomes in the merged data (in chromosome_sorter order)"""
+    return list(get_attributes(store, MERGED_GROUP).chromosomes)
+
+
+def get_merged_row_count(
+    store: pd.HDFStore, chromosome: str | None = None
+) -> int:
+    """Get the number of loci in a chromosome (or all) of the merged data"""
+    if chromosome is None:
+        return sum(
+            get_merged_row_count(store, chromosome)
+            for chromosome in get_chromosomes(store)
+        )
+    return int(get_table(store, get_coordinates_key(chromosome)).nrows)
+
+
+def get_max_span(store: pd.HDFStore, chromosome: str) -> int:
+    """Get the length of the longest locus of a chromosome
+
+    This is recorded when the coordinates are indexed (see
+    `index_coordinates`).
+    """
+    return int(
+        store.get_storer(get_coordinates_key(chromosome)).attrs.max_span
+    )
+
+
+def iter_row_chunks(
+    row_ranges: RowRanges, chunk_size: int
+) -> Iterator[slice | npt.NDArray[np.int64]]:
+    """Split ranges of rows, [start, stop), into chunks of chunk_size rows
+
+    Chunks that are a single range of rows are given as a slice (which is
+    read faster), otherwise the rows of the chunk are given.
+    """
+    pieces: RowRanges = []
+    size = 0
+    for start, stop in row_ranges:
+        while start < stop:
+            piece_stop = min(stop, start + chunk_size - size)
+            pieces.append((start, piece_stop))
+            size += piece_stop - start
+            start = piece_stop
+            if size == chunk_size:
+                yield to_rows(pieces)
+                pieces, size = [], 0
+    if pieces:
+        yield to_rows(pieces)
+
+
+def to_rows(row_ranges: RowRanges) -> slice | npt.NDArray[np.int64]:
+    """Convert ranges of rows into a slice (if possible) or rows"""
+    if len(row_ranges) == 1:
+        return slice(*row_ranges[0])
+    return np.concatenate(
+        [np.arange(start, stop) for start, stop in row_ranges]
+    )
+
+
+def select_rows(
+    store: pd.HDFStore,
+    key: str,
+    rows: slice | npt.NDArray[np.int64],
+    columns: list[str] | None = None,
+) -> pd.DataFrame:
+    """Read a slice of rows or the given (ascending) rows of a table"""
+    if isinstance(rows, slice):
+        return store.select(  # type: ignore[return-value]
+            key, start=rows.start, stop=rows.stop, columns=columns
+        )
+    return store.select(  # type: ignore[return-value]
+        key, where=rows, columns=columns
+    )
+
+
+def has_stats(store: pd.HDFStore, group: str = STATS_GROUP) -> bool:
+    """Check that there are p-values for every locus in the merged data"""
+    return group in store and all(
+        get_stats_key(chromosome, group) in store
+        and store.get_storer(get_stats_key(chromosome, group)).nrows
+        == get_merged_row_count(store, chromosome)
+        for chromosome in get_chromosomes(store)
+    )
+
+
+def find_stats(store: pd.HDFStore, samples: list[str] | None = None) -> str:
+    """Get the group of the p-values computed against samples
+
+    Raises an error if these p-values have not been computed (see
+    `get_stats_group`).
+    """
+    group = get_stats_group(store, samples)
+    if group == STATS_GROUP or (
+        has_stats(store, group)
+        and set(get_attributes(store, group).samples) == set(samples or [])
+    ):
+        return group
+    subset = ",".join(samples or [])
+    raise HDFReadError(
+        f"There are no p-values for the samples {subset}. Compute them "
+        f"with squire stats --samples {subset}"
+    )
+
+
+class SampleWriter:
+    """Appends parsed chunks of a bedmethyl file to /data/<sample>
+
+    Chunks must be appended in file order. Bedmethyl files from modkit have
+    each chromosome as a contiguous block of rows, sorted by start position.
+    This is checked as chunks are appended, and the row range of each
+    chromosome is recorded so that `create_merged_dataset` can stream the
+    data one chromosome at a time. As such, the chromosome is not stored
+    with every row. Modification codes (name) are stored as small integer
+    codes, and positions and counts as uint32 (this is checked). The largest
+    count is recorded so that the merged data can use the smallest integer
+    type that holds the counts (see `get_count_dtype`).
+
+    The number of lines read is tracked so that errors found in a chunk can
+    be reported with their line number in the file (see `locate`).
+
+    If only some chromosomes are added (chromosomes is not None), the file
+    can have no rows for them (e.g. chrY in female samples, or the
+    chromosomes of a shard). The sample is then given an empty table, so
+    that it is still part of the merged data.
+    """
+
+    def __init__(
+        self,
+        store: pd.HDFStore,
+        file_path: Path,
+        basename: str,
+        chromosomes: list[str] | None = None,
+    ) -> None:
+        self.store = store
+        self.file_path = file_path
+        self.chromosomes = chromosomes
+        self.key = f"data/{basename}"
+        self.count_columns = [
+            f"{basename}_read_depth",
+            f"{basename}_modifications",
+        ]
+        self.max_count = 0
+        self.rows_written = 0
+        self.lines_read = 0
+        self.region: str | None = None
+        self.chromosome_rows: dict[str, tuple[int, int]] = {}
+        self.names: dict[str, int] = {}
+        self.last_chromosome: str | None = None
+        self.last_start = -1
+
+    def locate(self, error: BedMethylLineError) -> BedMethylReadError:
+        """Convert an error in the current chunk to one for the whole file"""
+        line_number = self.lines_read + error.line + 1
+        location = (
+            f"line {line_number}"
+            if self.region is None
+            else f"line {line_number} of the {self.region} lines"
+        )
+        return BedMethylReadError(
+            f"{self.file_path} is malformed at {location}: {error.reason}"
+        )
+
+    def check_sorted(
+        self, chromosome: str, starts: npt.NDArray, lines: npt.NDArray
+    ) -> None:
+        """Check a run of rows for one chromosome continues the sort order"""
+        continues_run = chromosome == self.last_chromosome
+        if not continues_run and "/" in chromosome:
+            # Chromosomes are used as the names of groups in the hdf5 file
+            raise BedMethylLineError(
+                int(lines[0]),
+                f"chromosome names can't contain '/' ({chromosome})",
+            )
+        if (not continues_run and chromosome in self.chromosome_rows) or (
+            continues_run and starts[0] < self.last_start
+        ):
+            raise BedMethylLineError(
+                int(lines[0]),
+                "the file is not sorted. Each chromosome must be a "
+                "contiguous block of lines, sorted by start position.\n"
+                "Sort the file with: sort -k1,1 -k2,2n",
+            )
+        unsorted = np.flatnonzero(np.diff(starts) < 0)
+        if unsorted.size:
+            raise BedMethylLineError(
+                int(lines[unsorted[0] + 1]),
+                f"the file is not sorted by start position within "
+                f"{chromosome}.\nSort the file with: sort -k1,1 -k2,2n",
+            )
+
+    def start_region(self, region: str) -> None:
+        """Count lines from the start of a chromosome found using an index"""
+        self.region = region
+        self.lines_read = 0
+
+    def append(self, bedmethyl: pd.DataFrame, number_of_lines: int) -> None:
+        """Append the next parsed chunk of the bedmethyl file
+
+        Parameters
+        ---
+        number_of_lines: int
+            The number of lines in the chunk (before any were filtered out).
+        """
+        if not bedmethyl.empty:
+            self.write(bedmethyl)
+        self.lines_read += number_of_lines
+
+    def write(self, bedmethyl: pd.DataFrame) -> None:
+        """Check the sort order of a parsed chunk and write it to the store"""
+        chromosomes = bedmethyl["chr"].to_numpy()
+        starts = bedmethyl["start"].to_numpy()
+        lines = bedmethyl.index.to_numpy()
+        run_starts = [
+            0,
+            *(np.flatnonzero(chromosomes[1:] != chromosomes[:-1]) + 1),
+        ]
+        run_stops = [*run_starts[1:], len(bedmethyl)]
+        for run_start, run_stop in zip(run_starts, run_stops, strict=True):
+            chromosome = str(chromosomes[run_start])
+            self.check_sorted(
+                chromosome,
+                starts[run_start:run_stop],
+                lines[run_start:run_stop],
+            )
+            first_row, _ = self.chromosome_rows.get(
+                chromosome, (self.rows_written + run_start, 0)
+            )
+            self.chromosome_rows[chromosome] = (
+                first_row,
+                self.rows_written + run_stop,
+            )
+            self.last_chromosome = chromosome
+            self.last_start = starts[run_stop - 1]
+
+        largest = (
+            bedmethyl[["end", *self.count_columns]].max(axis=1).to_numpy()
+        )
+        too_large = largest > np.iinfo(np.uint32).max
+        if too_large.any():
+            raise BedMethylLineError(
+                int(lines[np.argmax(too_large)]),
+                "positions and counts must be less than 2^32",
+            )
+        # Loci are packed into 64 bit keys when they are merged
+        too_long = (
+            bedmethyl["end"] - bedmethyl["start"]
+        ).to_numpy() > MAX_SPAN
+        if too_long.any():
+            raise BedMethylLineError(
+                int(lines[np.argmax(too_long)]),
+                f"loci must be at most {MAX_SPAN} bases long",
+            )
+        self.max_count = max(
+            self.max_count, int(bedmethyl[self.count_columns].max().max())
+        )
+
+        for name in bedmethyl["name"].unique():
+            self.names.setdefault(name, len(self.names))
+        bedmethyl = bedmethyl.drop(columns="chr").assign(
+            name=bedmethyl["name"]
+            .map(self.names)  # type: ignore[arg-type]
+            .astype("uint16")
+        )
+        self.store.append(
+            self.key,
+            bedmethyl.reset_index(drop=True).astype(
+                dict.fromkeys(["start", "end", *self.count_columns], "uint32")
+            ),
+            format="table",
+            index=False,
+            **COMPRESSION,
+        )
+        self.rows_written += len(bedmethyl)
+
+    def write_empty(self) -> None:
+        """Create the (empty) table of a file without rows to add
+
+        pandas does not write empty tables, so a row is written and removed.
+        """
+        self.store.append(
+            self.key,
+            pd.DataFrame(
+                {"start": [0], "end": [0], "name": [0]}
+                | {column: [0] for column in self.count_columns}
+            ).astype(
+                dict.fromkeys(["start", "end", *self.count_columns], "uint32")
+                | {"name": "uint16"}
+            ),
+            format="table",
+            index=False,
+            **COMPRESSION,
+        )
+        self.store.remove(self.key, start=0, stop=1)
+
+    def close(self) -> None:
+        """Record the chromosome rows, modification codes and largest count
+
+        A file without rows is only an error if it has no rows for any
+        chromosome, rather than just for the chromosomes being added.
+        """
+        if self.rows_written == 0:
+            if self.chromosomes is None or not get_chromosome_sizes(
+                self.file_path
+            ):
+                raise BedMethylReadError(
+                    f"No data was read from {self.file_path}."
+                )
+            self.write_empty()
+        attributes = self.store.get_storer(self.key).attrs
+        attributes.chromosome_rows = self.chromosome_rows
+        attributes.names = list(self.names)
+        attributes.max_count = self.max_count
+
+
+def check_chromosomes_found(
+    found: Iterable[str], chromosomes: list[str]
+) -> None:
+    """Check that every chromosome to add is found in the bedmethyl files
+
+    Raises
+    ---
+    BedMethylReadError
+        If any of the chromosomes are not in the files.
+    """
+    found = set(found)
+    missing = [
+        chromosome for chromosome in chromosomes if chromosome not in found
     ]
-    column_dtypes = {
-        "chr": str,
-        "start": int,
-        "end": int,
-        "name": str,
-        f"{basename}_read_depth": int,
-        f"{basename}_modifications": int,
+    if missing:
+        raise BedMethylReadError(
+            f"None of the bedmethyl files have rows for {', '.join(missing)}."
+            " Check that the requested chromosomes are named as in the files"
+            " (e.g. chr1 rather than 1)."
+        )
+
+
+def add_files_to_hdf_store(
+    file_paths: list[Path],
+    hdf_path: Path,
+    workers: WorkerPool,
+    chromosomes: list[str] | None = None,
+    chunk_bytes: int = 32 * 1024**2,
+) -> None:
+    """Add bedmethyl files to a hdf5 store, parsing them in parallel
+
+    Each file is split into chunks of roughly chunk_bytes (see
+    `split_bedmethyl`), which are parsed by the workers at the same time
+    (across and within files), so memory use is bounded by the chunk size
+    and the number of workers. PyTables does not support concurrent writes,
+    so the parsed chunks are appended to the store (in file order) by this
+    (single) process. If any file can't be added, the tables written for
+    every file are removed again.
+
+    Parameters
+    ---
+    chromosomes: list[str] | None
+        Only add the data for these chromosomes (all chromosomes if None).
+        Each of them must be in at least one of the files.
+    """
+    mode_to_use = "w" if not os.path.exists(hdf_path) else "a"
+    owners: deque[tuple[Path, str | None]] = deque()
+
+    def tasks() -> Iterator[tuple[Chunk, str, list[str] | None]]:
+        for file_path in file_paths:
+            basename = get_file_basename(file_path)
+            for chunk, keep in split_bedmethyl(
+                file_path, chunk_bytes, chromosomes
+            ):
+                region = chunk.region if isinstance(chunk, BGZFRange) else None
+                owners.append((file_path, region))
+                yield chunk, basename, keep
+
+    with pd.HDFStore(hdf_path, mode=mode_to_use) as store:
+        writers = {
+            file_path: SampleWriter(
+                store, file_path, get_file_basename(file_path), chromosomes
+            )
+            for file_path in file_paths
+        }
+
+        def current_writer() -> SampleWriter:
+            # Tasks are generated lazily, each result's owner is queued first
+            file_path, region = owners[0]
+            if region is not None:
+                writers[file_path].start_region(region)
+            return writers[file_path]
+
+        try:
+            try:
+                for bedmethyl, number_of_lines in ordered_imap(
+                    workers, parse_chunk, tasks()
+                ):
+                    current_writer().append(bedmethyl, number_of_lines)
+                    owners.popleft()
+            except BedMethylLineError as e:
+                raise current_writer().locate(e) from None
+            except BedMethylReadError as e:
+                raise BedMethylReadError(
+                    f"Failed to parse {owners[0][0]}. {e}"
+                ) from e.__cause__
+            for writer in writers.values():
+                writer.close()
+            if chromosomes is not None:
+                check_chromosomes_found(
+                    (
+                        chromosome
+                        for writer in writers.values()
+                        for chromosome in writer.chromosome_rows
+                    ),
+                    chromosomes,
+                )
+        except BaseException:
+            # Chunks are written as they are parsed, so the tables of a
+            # failed call are removed rather than left without attributes
+            for writer in writers.values():
+                if writer.key in store:
+                    store.remove(writer.key)
+            raise
+
+
+def read_chromosome(
+    store: pd.HDFStore,
+    path: str,
+    chromosome: str,
+    chunk_size: int,
+    names: pd.Index,
+) -> Iterator[pd.DataFrame]:
+    """Read the rows of a parsed bedmethyl file for one chromosome in chunks
+
+    See `SampleWriter` for how the parsed bedmethyl files are stored. The
+    loci of each chunk are packed into a key column (see `pack_loci`), with
+    the modification codes (name) given their position in names.
+    """
+    attributes = store.get_storer(path).attrs
+    if chromosome not in attributes.chromosome_rows:
+        return
+    start, stop = attributes.chromosome_rows[chromosome]
+    name_codes = names.get_indexer(attributes.names)
+    for chunk in store.select(
+        path, start=start, stop=stop, chunksize=chunk_size
+    ):
+        keys = pack_loci(
+            chunk["start"].to_numpy(),
+            chunk["end"].to_numpy(),
+            name_codes[chunk["name"].to_numpy()],
+        )
+        yield chunk.drop(columns=["start", "end", "name"]).assign(key=keys)
+
+
+def join_on_keys(parts: list[pd.DataFrame]) -> pd.DataFrame:
+    """Outer join chunks (with a key column) on their keys
+
+    The union of the keys is found with np.unique (which also sorts it) and
+    each chunk is aligned to it with np.searchsorted. Values for keys that
+    are missing from a chunk are left as NaN.
+    """
+    keys = np.unique(
+        np.concatenate([part["key"].to_numpy() for part in parts])
+    )
+    columns = {}
+    for part in parts:
+        rows = np.searchsorted(keys, part["key"].to_numpy())
+        for column in part.columns.drop("key"):
+            values = np.full(len(keys), np.nan)
+            values[rows] = part[column].to_numpy()
+            columns[column] = values
+    return pd.DataFrame(columns, index=pd.Index(keys, name="key"))
+
+
+def merge_sorted_chunks(
+    streams: list[Iterator[pd.DataFrame]],
+) -> Iterator[pd.DataFrame]:
+    """k-way outer merge of streams of chunks sorted by start position
+
+    Each stream yields chunks (with a key column, see `pack_loci`) for a
+    single chromosome. Rows are only emitted once every stream has moved past
+    their start position, so each emitted block contains every sample's data
+    for its loci. Memory use is bounded by the size of the chunks.
+
+    Blocks are indexed by key (see `join_on_keys`). Values for loci that are
+    missing from a stream are left as NaN.
+    """
+    buffers: list[pd.DataFrame | None] = [None for _ in streams]
+    exhausted = [False for _ in streams]
+
+    def pull(index: int) -> None:
+        chunk = next(streams[index], None)
+        buffer = buffers[index]
+        if chunk is None:
+            exhausted[index] = True
+        elif buffer is None:
+            buffers[index] = chunk
+        else:
+            buffers[index] = pd.concat([buffer, chunk])
+
+    while True:
+        for index in range(len(streams)):
+            while buffers[index] is None and not exhausted[index]:
+                pull(index)
+        pending = [
+            (index, buffer)
+            for index, buffer in enumerate(buffers)
+            if buffer is not None
+        ]
+        if not pending:
+            return
+
+        starts = {
+            index: key_starts(buffer["key"].to_numpy())
+            for index, buffer in pending
+        }
+        open_ends = [
+            starts[index][-1] for index, _ in pending if not exhausted[index]
+        ]
+        frontier = min(open_ends) if open_ends else None
+        ready = {
+            index: (
+                starts[index] < frontier
+                if frontier is not None
+                else np.ones(len(buffer), dtype=bool)
+            )
+            for index, buffer in pending
+        }
+
+        if not any(mask.any() for mask in ready.values()):
+            # Every buffer starts at the frontier, the streams ending there
+            # need more rows to be sure that the position is complete
+            for index, _ in pending:
+                if not exhausted[index] and starts[index][-1] == frontier:
+                    pull(index)
+            continue
+
+        parts = []
+        for index, buffer in pending:
+            mask = ready[index]
+            parts.append(buffer.loc[mask])
+            remaining = buffer.loc[~mask]
+            buffers[index] = None if remaining.empty else remaining
+        yield join_on_keys(parts)
+
+
+def get_merged_names(store: pd.HDFStore) -> list[str]:
+    """Get the modification codes (names) in the merged data"""
+    names: set[str] = set()
+    for chromosome in get_chromosomes(store):
+        coordinates: pd.DataFrame = store.select(  # type: ignore[assignment]
+            get_coordinates_key(chromosome), start=0, stop=0
+        )
+        names.update(coordinates["name"].cat.categories)
+    return sorted(names)
+
+
+def get_parsed_chromosomes(
+    store: pd.HDFStore, bedmethyl_paths: list[str]
+) -> list[str]:
+    """Get the chromosomes in parsed bedmethyl files (in genomic order)"""
+    return sorted(
+        set().union(
+            *(
+                store.get_storer(path).attrs.chromosome_rows
+                for path in bedmethyl_paths
+            )
+        ),
+        key=chromosome_sorter,
+    )
+
+
+def get_parsed_row_count(
+    store: pd.HDFStore, path: str, chromosome: str
+) -> int:
+    """Get the number of rows a parsed bedmethyl file has for a chromosome"""
+    start, stop = store.get_storer(path).attrs.chromosome_rows.get(
+        chromosome, (0, 0)
+    )
+    return stop - start
+
+
+def get_merged_dtypes(
+    store: pd.HDFStore, bedmethyl_paths: list[str], names: set[str]
+) -> dict:
+    """Get the dtypes of the merged data for newly parsed bedmethyl files
+
+    Modification codes (names) are categories, stored as small integer codes.
+    Counts use the smallest unsigned integer type that holds the sample's
+    counts. The chromosome is not stored, as it is the partition.
+    """
+    dtypes = {
+        "start": "uint32",
+        "end": "uint32",
+        "name": pd.CategoricalDtype(
+            sorted(
+                names.union(
+                    *(
+                        store.get_storer(path).attrs.names
+                        for path in bedmethyl_paths
+                    )
+                )
+            )
+        ),
     }
-    bedmethyl = pd.read_csv(
-        file_path,
-        sep=r"\s+",  # bedmethyl has mix of tabs and spaces for separators
-        header=None,
-        usecols=columns_to_keep,  # type: ignore[arg-type]
-        names=column_names,
-        dtype=column_dtypes,  # type: ignore[arg-type]
-    )
-    bedmethyl[f"{basename}_fraction"] = (
-        bedmethyl[f"{basename}_modifications"]
-        / bedmethyl[f"{basename}_read_depth"]
-        * 100
+    for path in bedmethyl_paths:
+        count_dtype = get_count_dtype(store.get_storer(path).attrs.max_count)
+        sample = path.removeprefix("/data/")
+        for field in SAMPLE_FIELDS:
+            dtypes[f"{sample}_{field}"] = count_dtype
+    return dtypes
+
+
+def read_merged(
+    store: pd.HDFStore,
+    chromosome: str,
+    rows: slice | npt.NDArray[np.int64],
+    samples: list[str] | None = None,
+    fields: list[str] = SAMPLE_FIELDS,
+) -> pd.DataFrame:
+    """Read rows (a slice or the rows themselves) of a chromosome's merged data
+
+    Only the tables of the given samples (all samples if None) are read.
+    Returns a dataframe indexed by locus (chr, start, end, name) with a
+    <sample>_<field> column for each sample and field.
+    """
+    samples = get_sample_names(store) if samples is None else samples
+    coordinates = select_rows(store, get_coordinates_key(chromosome), rows)
+    coordinates.insert(0, "chr", chromosome)
+    sample_columns = [
+        select_rows(
+            store,
+            get_sample_key(sample, chromosome),
+            rows,
+            [f"{sample}_{field}" for field in fields],
+        )
+        for sample in samples
+    ]
+    return pd.concat(
+        [coordinates, *sample_columns], axis=1  # type: ignore[arg-type]
+    ).set_index(COORDINATE_COLUMNS)
+
+
+def get_count_dtype(max_count: int) -> str:
+    """Get the smallest unsigned integer type that holds every count"""
+    for dtype in ("uint16", "uint32"):
+        if max_count <= np.iinfo(dtype).max:
+            return dtype
+    raise BedMethylReadError(f"A count of {max_count} is too large to store")
+
+
+def read_merged_coordinates(
+    store: pd.HDFStore,
+    chromosome: str,
+    chunk_size: int,
+    p_values: bool,
+    names: pd.Index,
+) -> Iterator[pd.DataFrame]:
+    """Read the coordinates of a chromosome in chunks
+
+    Chunks have the same layout as `read_chromosome` so that the existing
+    loci can be merged with newly parsed bedmethyl files, with the row
+    number of each locus (old_row). If p_values is set, the p_value of each
+    locus is read from stats as well.
+    """
+    if chromosome not in get_chromosomes(store):
+        return
+    row_count = get_merged_row_count(store, chromosome)
+    for start in range(0, row_count, chunk_size):
+        stop = min(start + chunk_size, row_count)
+        coordinates: pd.DataFrame = store.select(  # type: ignore[assignment]
+            get_coordinates_key(chromosome), start=start, stop=stop
+        )
+        name_codes = names.get_indexer(coordinates["name"].cat.categories)
+        chunk = pd.DataFrame(
+            {
+                "key": pack_loci(
+                    coordinates["start"].to_numpy(),
+                    coordinates["end"].to_numpy(),
+                    name_codes[coordinates["name"].cat.codes.to_numpy()],
+                ),
+                "old_row": np.arange(start, stop),
+            }
+        )
+        if p_values:
+            chunk["p_value"] = get_table(
+                store, get_stats_key(chromosome)
+            ).read(start, stop, field="p_value")
+        yield chunk
+
+
+def append_stats(
+    store: pd.HDFStore,
+    key: str,
+    coordinates: pd.DataFrame,
+    p_values: npt.NDArray[np.float64],
+) -> None:
+    """Append p-values (and the loci they are for) to a stats table
+
+    The coordinates are the start, end and name of each locus. The name
+    column is expected to be categorical (as it is in the merged data), so
+    that it is stored as codes. p-values are kept as float64, as float32
+    can't hold p-values below ~1e-38.
+
+    The table is indexed once every chunk has been appended (see
+    `index_stats`).
+    """
+    store.append(
+        key,
+        coordinates.assign(p_value=p_values),
+        format="table",
+        data_columns=True,
+        index=False,
+        **COMPRESSION,
     )
-    with pd.HDFStore(hdf_path, mode=mode_to_use) as store:
+
+
+def index_stats(store: pd.HDFStore, key: str) -> None:
+    """Create a completely sorted index of the p-values of a stats table
+
+    This lets threshold queries (where="p_value < t") read only the rows
+    that pass the threshold (see `export_cpg_list`).
+    """
+    store.create_table_index(key, columns=["p_value"], optlevel=9, kind="full")
+
+
+def append_merged_block(
+    store: pd.HDFStore,
+    block: pd.DataFrame,
+    chromosome: str,
+    samples: list[str],
+    dtypes: dict,
+    first_row: int,
+    expected_rows: int,
+) -> pd.DataFrame:
+    """Append a block of merged loci (see `merge_sorted_chunks`) to a partition
+
+    The loci are unpacked from the keys that the block is indexed by.
+
+    The loci are appended to the coordinates table of the chromosome, and
+    each sample's columns to its own table. All NaN entries will be converted
+    to 0 so as to avoid differening line lengths when exporting the data to a
+    reference matrix. Columns are given the (compact) dtypes in dtypes.
+
+    expected_rows is used to choose the chunk shape of new tables.
+
+    Returns the block as it was appended (with start, end and name columns,
+    indexed by row number).
+    """
+    starts, ends, names = unpack_loci(block.index.to_numpy())
+    block = (
+        block.reindex(
+            columns=[
+                f"{sample}_{field}"
+                for sample in samples
+                for field in SAMPLE_FIELDS
+            ]
+        )
+        .fillna(0)
+        .reset_index(drop=True)
+        .assign(
+            start=starts,
+            end=ends,
+            name=pd.Categorical.from_codes(names, dtype=dtypes["name"]),
+        )
+        .astype(dtypes)
+    )
+    block.index = pd.RangeIndex(first_row, first_row + len(block))
+    # Indexing every append is slow, the table is indexed once at the end
+    store.append(
+        get_coordinates_key(chromosome),
+        block[COORDINATE_COLUMNS[1:]],
+        format="table",
+        data_columns=True,
+        index=False,
+        expectedrows=expected_rows,
+        **COMPRESSION,
+    )
+    for sample in samples:
         store.append(
-            f"data/{basename}",
-            bedmethyl,
+            get_sample_key(sample, chromosome),
+            block[[f"{sample}_{field}" for field in SAMPLE_FIELDS]],
             format="table",
-            data_columns=True,
+            index=False,
+            expectedrows=expected_rows,
+            **COMPRESSION,
         )
+    return block
 
 
-def generate_coordinate_index(
-    hdf_path: Path, chunk_size: int = 100_000
+def index_coordinates(
+    store: pd.HDFStore, chromosome: str, max_span: int
 ) -> None:
-    """Generates a full index of genomic loci coordinates from hdf5 store"""
-    with pd.HDFStore(hdf_path, mode="a") as store:
-        all_coordinates = []
-        data_paths = [key for key in store if key.startswith("/data/")]
-        for path in data_paths:
-            for chunk in store.select(
-                path,
-                columns=["chr", "start", "end", "name"],
-                chunksize=chunk_size,
-            ):
-                all_coordinates.append(chunk)
+    """Index the coordinates of a chromosome once all loci are appended
 
-        coordinates = (
-            pd.concat(all_coordinates, ignore_index=True)
-            .drop_duplicates()
-            .sort_values(
-                by=["chr", "start", "end", "name"],
-                key=lambda x: x.map(chromosome_sorter)
-                if x.name == "chr"
-                else x,
-            )
-            .reset_index(drop=True)
-            .astype(
-                {
-                    "chr": "category",
-                    "start": "uint32",
-                    "end": "uint32",
-                    "name": "category",
-                }
+    The longest locus (max_span) is recorded too, it bounds how far before
+    a region the loci that overlap it can start (see `find_rows`).
+    """
+    key = get_coordinates_key(chromosome)
+    store.create_table_index(key, columns=["start", "end"])
+    store.get_storer(key).attrs.max_span = max_span
+
+
+def get_span(block: pd.DataFrame) -> int:
+    """Get the length of the longest locus in a block of merged loci"""
+    return int(
+        np.max(
+            block["end"].to_numpy(np.int64)
+            - block["start"].to_numpy(np.int64),
+            initial=0,
+        )
+    )
+
+
+def write_sorted_p_values(
+    store: pd.HDFStore, group: str = STATS_GROUP
+) -> None:
+    """Store every p-value in ascending order (replacing any existing ones)
+
+    This lets the number of p-values below a threshold be found with a
+    binary search (see `count_p_values_below`).
+    """
+    key = get_sorted_p_values_key(group)
+    if key in store:
+        store.remove(key)
+    p_values = np.sort(
+        np.concatenate(
+            [
+                store.select_column(
+                    get_stats_key(chromosome, group), "p_value"
+                )
+                for chromosome in get_chromosomes(store)
+            ]
+        )
+    )
+    parent, _, name = f"/{key}".rpartition("/")
+    store._handle.create_carray(  # type: ignore[union-attr]
+        parent or "/",
+        name,
+        obj=p_values,
+        filters=tables.Filters(**COMPRESSION),
+    )
+
+
+def count_p_values_below(
+    store: pd.HDFStore,
+    thresholds: list[float],
+    row_ranges: dict[str, RowRanges] | None = None,
+    group: str = STATS_GROUP,
+) -> list[int]:
+    """Count the p-values below each threshold
+
+    Uses a binary search of the sorted p-values (see `write_sorted_p_values`),
+    so only a few p-values are read for each threshold. Stores without
+    sorted p-values have their stats read (and sorted) instead.
+
+    Parameters
+    ---
+    row_ranges: dict[str, RowRanges] | None
+        Only count the p-values in these ranges of rows of each chromosome
+        (see `find_rows`). These p-values are read and sorted.
+    group: str
+        The stats group to count the p-values of (see `get_stats_group`)
+    """
+    if row_ranges is not None:
+        p_values = np.sort(
+            np.concatenate(
+                [
+                    get_table(store, get_stats_key(chromosome, group)).read(
+                        start, stop, field="p_value"
+                    )
+                    for chromosome, ranges in row_ranges.items()
+                    for start, stop in ranges
+                ]
+                or [np.empty(0)]
             )
         )
-        store.put(
-            "coordinates", coordinates, format="table", data_columns=True
+        return np.searchsorted(p_values, thresholds).tolist()
+    if get_sorted_p_values_key(group) in store:
+        sorted_p_values: tables.CArray = store.get_node(
+            get_sorted_p_values_key(group)
+        )  # type: ignore[assignment]
+        return [
+            bisect.bisect_left(sorted_p_values, threshold)
+            for threshold in thresholds
+        ]
+    p_values = np.sort(
+        np.concatenate(
+            [
+                store.select_column(
+                    get_stats_key(chromosome, group), "p_value"
+                )
+                for chromosome in get_chromosomes(store)
+            ]
+        )
+    )
+    return np.searchsorted(p_values, thresholds).tolist()
+
+
+def realign_sample(
+    store: pd.HDFStore,
+    partition: pd.HDFStore,
+    sample: str,
+    chromosome: str,
+    chunk_size: int,
+) -> None:
+    """Copy a sample's data for a chromosome into a partition with new loci
+
+    The partition's old_rows table holds the (old) row number of each of its
+    loci, or -1 for inserted loci, which are given 0 for each field. The
+    sample has no data if the chromosome is new, so every field is 0.
+
+    The sample's table keeps its dtypes, these can differ between
+    chromosomes (see `merge_shards`).
+    """
+    old_key = get_sample_key(sample, chromosome)
+    dtypes = (
+        store.select(
+            old_key, start=0, stop=0
+        ).dtypes.to_dict()  # type: ignore[union-attr]
+        if old_key in store
+        else {f"{sample}_{field}": "uint16" for field in SAMPLE_FIELDS}
+    )
+    old_rows_key = f"{MERGED_GROUP}/{chromosome}/old_rows"
+    row_count = int(get_table(partition, old_rows_key).nrows)
+    for start in range(0, row_count, chunk_size):
+        stop = min(start + chunk_size, row_count)
+        old_rows = partition.select(  # type: ignore[index]
+            old_rows_key, start=start, stop=stop
+        )["old_row"].to_numpy()
+        existing = np.flatnonzero(old_rows >= 0)
+        chunk = pd.DataFrame(
+            {
+                column: np.zeros(stop - start, dtype=dtype)
+                for column, dtype in dtypes.items()
+            },
+            index=pd.RangeIndex(start, stop),
         )
-        store.create_table_index(
-            "coordinates", columns=["chr", "start", "end"], kind="full"
+        if existing.size:
+            # Old loci are kept in order, so their rows are contiguous
+            chunk.iloc[existing] = store.select(
+                old_key,
+                start=old_rows[existing[0]],
+                stop=old_rows[existing[-1]] + 1,
+            ).to_numpy()  # type: ignore[union-attr]
+        partition.append(
+            get_sample_key(sample, chromosome),
+            chunk,
+            format="table",
+            index=False,
+            expectedrows=row_count,
+            **COMPRESSION,
         )
 
 
-def add_bedmethyls_to_merged_data(
-    store: pd.HDFStore, merged: pd.DataFrame
+def replace_node(store: pd.HDFStore, key: str, replacement: str) -> None:
+    """Replace a node in the store with another (which is renamed)"""
+    if key in store:
+        store.remove(key)
+    store.get_node(replacement)._f_rename(key)  # type: ignore[union-attr]
+
+
+def get_group(store: pd.HDFStore, key: str) -> tables.Group:
+    """Get a group of the store, creating it (and its parents) if needed"""
+    if key in store:
+        return store.get_node(key)  # type: ignore[return-value]
+    parent, _, name = f"/{key}".rpartition("/")
+    return store._handle.create_group(  # type: ignore[union-attr]
+        parent or "/", name, createparents=True
+    )
+
+
+def copy_node(
+    source_path: Path, key: str, store: pd.HDFStore, new_key: str
 ) -> None:
-    """Add bedmethyl files to the combined merged data"""
-    bedmethyl_paths = [k for k in store if k.startswith("/data/")]
+    """Copy a node (with its children) from another hdf5 file into the store
 
-    for path in bedmethyl_paths:
-        bedmethyl = store[path].set_index(["chr", "start", "end", "name"])
-        merged = merged.join(bedmethyl, how="left")
-    merged = merged.fillna(0)
-    store.put("merged_data", merged, format="table", data_columns=True)
-    for path in bedmethyl_paths:
-        store.remove(path)
+    Attributes and table indexes are copied with the node.
+    """
+    parent, _, name = new_key.rpartition("/")
+    with tables.open_file(str(source_path), mode="r") as source:
+        source.get_node(f"/{key}")._f_copy(
+            newparent=get_group(store, parent),
+            newname=name,
+            recursive=True,
+            propindexes=True,
+        )
+
+
+def map_partitions[T](
+    workers: WorkerPool,
+    function: Callable[..., T],
+    arguments: list[tuple],
+) -> list[T]:
+    """Apply function to each partition's arguments using the workers
+
+    PyTables is not thread safe, so with thread workers the partitions are
+    processed one at a time (by this thread).
+    """
+    if workers.backend == "thread":
+        return [function(*argument) for argument in arguments]
+    return list(ordered_imap(workers, function, arguments))
+
+
+def merge_partition(
+    hdf_path: Path,
+    partition_path: Path,
+    chromosome: str,
+    bedmethyl_paths: list[str],
+    dtypes: dict,
+    chunk_size: int,
+) -> None:
+    """Merge one chromosome of the parsed bedmethyl files into its own file
+
+    Each parsed bedmethyl file is sorted by position within each chromosome,
+    so the files are merged with a streaming k-way merge. Blocks of merged
+    loci are appended as they are produced, so memory use scales with the
+    chunk size rather than the size of the chromosome.
+
+    The hdf5 file is only read, PyTables can't write to a file from more
+    than one process. The partition is written to partition_path instead.
+    """
+    samples = [path.removeprefix("/data/") for path in bedmethyl_paths]
+    with (
+        pd.HDFStore(hdf_path, mode="r") as store,
+        pd.HDFStore(partition_path, mode="w") as partition,
+    ):
+        streams = [
+            read_chromosome(
+                store, path, chromosome, chunk_size, dtypes["name"].categories
+            )
+            for path in bedmethyl_paths
+        ]
+        # Every row of the largest file is a row of the merged data
+        expected_rows = max(
+            get_parsed_row_count(store, path, chromosome)
+            for path in bedmethyl_paths
+        )
+        rows_written = 0
+        max_span = 0
+        for block in merge_sorted_chunks(streams):
+            block = append_merged_block(
+                partition,
+                block,
+                chromosome,
+                samples,
+                dtypes,
+                rows_written,
+                expected_rows,
+            )
+            rows_written += len(block)
+            max_span = max(max_span, get_span(block))
+        index_coordinates(partition, chromosome, max_span)
+
+
+def create_merged_dataset(
+    hdf_path: Path, workers: WorkerPool, chunk_size: int = 100_000
+) -> None:
+    """Merges all parsed bedmethyl files into the merged data
 
+    The merged data is partitioned by chromosome, and each chromosome is
+    merged independently (see `merge_partition`) by the workers. Each
+    partition is written to a temporary file, which is then copied into
+    the hdf5 file. The samples and chromosomes (in `chromosome_sorter`
+    order) are recorded in the attributes of the merged group.
 
-def create_merged_dataset(hdf_path: Path) -> None:
-    """Merges all parsed bedmethyl files into a single dataframe
+    Also removes individually stored bedmethyl files so as to avoid file
+    bloat.
 
-    Using a hdf5 store and the coordinate index created from
-    `generate_coordinate_index`, each stored pandas dataframe will be merged
-    into a single dataframe (aligned on the coordinate index).
+    Parameters
+    ---
+    workers: WorkerPool
+        Worker pool that the chromosomes are merged in. Thread workers merge
+        the chromosomes one at a time (see `map_partitions`).
+    """
+    with pd.HDFStore(hdf_path, mode="r") as store:
+        bedmethyl_paths = [k for k in store if k.startswith("/data/")]
+        dtypes = get_merged_dtypes(store, bedmethyl_paths, set())
+        chromosomes = get_parsed_chromosomes(store, bedmethyl_paths)
+        sizes = {
+            chromosome: sum(
+                get_parsed_row_count(store, path, chromosome)
+                for path in bedmethyl_paths
+            )
+            for chromosome in chromosomes
+        }
+
+    with tempfile.TemporaryDirectory(
+        dir=Path(hdf_path).parent, prefix=".squire-"
+    ) as partition_dir:
+        partition_paths = {
+            chromosome: Path(partition_dir, f"{number}.h5")
+            for number, chromosome in enumerate(chromosomes)
+        }
+        # The largest chromosomes are merged first, so that the workers are
+        # not left waiting on a large chromosome at the end
+        map_partitions(
+            workers,
+            merge_partition,
+            [
+                (
+                    hdf_path,
+                    partition_paths[chromosome],
+                    chromosome,
+                    bedmethyl_paths,
+                    dtypes,
+                    chunk_size,
+                )
+                for chromosome in sorted(
+                    chromosomes, key=sizes.__getitem__, reverse=True
+                )
+            ],
+        )
+
+        with pd.HDFStore(hdf_path, mode="a") as store:
+            for chromosome, partition_path in partition_paths.items():
+                key = f"{MERGED_GROUP}/{chromosome}"
+                copy_node(partition_path, key, store, key)
+                os.remove(partition_path)
+            attributes = get_attributes(store, MERGED_GROUP)
+            attributes.samples = [
+                path.removeprefix("/data/") for path in bedmethyl_paths
+            ]
+            attributes.chromosomes = chromosomes
+            attributes.layout_version = LAYOUT_VERSION
+
+            for path in bedmethyl_paths:
+                store.remove(path)
+
+
+def check_new_samples(hdf_path: Path, file_paths: list[Path]) -> None:
+    """Check that the samples being added are not already in a hdf5 file"""
+    with pd.HDFStore(hdf_path, mode="r") as store:
+        samples = set(get_sample_names(store))
+    for file_path in file_paths:
+        if get_file_basename(file_path) in samples:
+            raise BedMethylReadError(
+                f"A sample called {get_file_basename(file_path)} is already "
+                f"in {hdf_path}. Rename {file_path} to add it."
+            )
+
+
+def add_partition(
+    hdf_path: Path,
+    partition_path: Path,
+    chromosome: str,
+    bedmethyl_paths: list[str],
+    dtypes: dict,
+    old_samples: list[str],
+    carry_p_values: bool,
+    chunk_size: int,
+) -> bool:
+    """Add one chromosome of the parsed bedmethyl files to its partition
+
+    The existing loci are streamed through the same k-way merge as the new
+    files (see `merge_partition`), but the existing samples are not read.
+    This is an outer merge, so loci that are only in the new files are kept.
+    The merged loci and the new samples are written to partition_path (the
+    hdf5 file is only read).
+
+    The existing p-values are carried into a new stats table alongside.
+    Adding samples only changes the p-value of loci where a new sample has
+    reads (samples without reads are dropped from the test), so the p-values
+    of these loci (and of new loci) are set to NaN, to be recomputed by
+    `update_p_values`.
+
+    Returns whether loci were inserted. If so, the existing samples are
+    copied into the partition with 0s for the inserted loci (see
+    `realign_sample`).
+    """
+    new_samples = [path.removeprefix("/data/") for path in bedmethyl_paths]
+    new_read_depth_columns = [f"{sample}_read_depth" for sample in new_samples]
+    old_rows_key = f"{MERGED_GROUP}/{chromosome}/old_rows"
+    with (
+        pd.HDFStore(hdf_path, mode="r") as store,
+        pd.HDFStore(partition_path, mode="w") as partition,
+    ):
+        old_row_count = (
+            get_merged_row_count(store, chromosome)
+            if chromosome in get_chromosomes(store)
+            else 0
+        )
+        expected_rows = old_row_count + max(
+            get_parsed_row_count(store, path, chromosome)
+            for path in bedmethyl_paths
+        )
+        streams = [
+            read_merged_coordinates(
+                store,
+                chromosome,
+                chunk_size,
+                carry_p_values,
+                dtypes["name"].categories,
+            ),
+            *(
+                read_chromosome(
+                    store,
+                    path,
+                    chromosome,
+                    chunk_size,
+                    dtypes["name"].categories,
+                )
+                for path in bedmethyl_paths
+            ),
+        ]
+        rows_written = 0
+        max_span = 0
+        for block in merge_sorted_chunks(streams):
+            # Loci that are only in the new files have no old row (or
+            # p-value)
+            old_rows = (
+                block.reindex(columns=["old_row"])["old_row"]
+                .fillna(-1)
+                .to_numpy(dtype=np.int64)
+            )
+            p_values = block.reindex(columns=["p_value"])["p_value"].to_numpy(
+                dtype=np.float64, copy=True
+            )
+            block = append_merged_block(
+                partition,
+                block,
+                chromosome,
+                new_samples,
+                dtypes,
+                rows_written,
+                expected_rows,
+            )
+            partition.append(
+                old_rows_key,
+                pd.DataFrame({"old_row": old_rows}, index=block.index),
+                format="table",
+                index=False,
+                **COMPRESSION,
+            )
+            rows_written += len(block)
+            max_span = max(max_span, get_span(block))
+            if carry_p_values:
+                new_reads = block[new_read_depth_columns].to_numpy() > 0
+                p_values[new_reads.any(axis=1)] = np.nan
+                append_stats(
+                    partition,
+                    get_stats_key(chromosome),
+                    block.loc[:, COORDINATE_COLUMNS[1:]],
+                    p_values,
+                )
+
+        if carry_p_values:
+            index_stats(partition, get_stats_key(chromosome))
+        inserted = rows_written != old_row_count
+        if inserted:
+            for sample in old_samples:
+                realign_sample(
+                    store, partition, sample, chromosome, chunk_size
+                )
+        partition.remove(old_rows_key)
+        index_coordinates(partition, chromosome, max_span)
+    return inserted
+
+
+def add_to_merged_dataset(
+    hdf_path: Path, workers: WorkerPool, chunk_size: int = 100_000
+) -> None:
+    """Add newly parsed files in /data/ to the merged data in hdf5 file
+
+    Each chromosome is added to independently (see `add_partition`) by the
+    workers, into temporary files. These partitions are copied into a new
+    group that replaces merged. If no loci were inserted into a chromosome,
+    the existing sample tables are moved into the new partition as they are.
 
-    All NaN entries will be converted to 0 so as to avoid differening line
-    lengths when exporting the data to a reference matrix.
+    The carried p-values are copied into a new stats group in the same way.
+    The sample set that the remaining p-values were computed against is
+    kept in the stats group's attributes. P-values of subsets of the samples
+    are removed, as loci may have been inserted (they are computed again
+    with `squire stats --samples`).
 
-    Also removes coordinate index and individually stored bedmethyl files so as
-    to avoid file bloat.
+    Parameters
+    ---
+    workers: WorkerPool
+        Worker pool that the chromosomes are merged in. Thread workers merge
+        the chromosomes one at a time (see `map_partitions`).
     """
-    with pd.HDFStore(hdf_path, mode="a") as store:
-        coords = store["coordinates"]
-        merged = coords.set_index(["chr", "start", "end", "name"]).copy()
-        add_bedmethyls_to_merged_data(store, merged)
-        store.remove("coordinates")
+    with pd.HDFStore(hdf_path, mode="r") as store:
+        bedmethyl_paths = [k for k in store if k.startswith("/data/")]
+        old_samples = get_sample_names(store)
+        old_chromosomes = get_chromosomes(store)
+        carry_p_values = has_stats(store)
+        stats_samples = (
+            list(get_attributes(store, STATS_GROUP).samples)
+            if carry_p_values
+            else []
+        )
+        dtypes = get_merged_dtypes(
+            store, bedmethyl_paths, set(get_merged_names(store))
+        )
+        chromosomes = sorted(
+            set(old_chromosomes).union(
+                get_parsed_chromosomes(store, bedmethyl_paths)
+            ),
+            key=chromosome_sorter,
+        )
+        sizes = {
+            chromosome: sum(
+                get_parsed_row_count(store, path, chromosome)
+                for path in bedmethyl_paths
+            )
+            + (
+                get_merged_row_count(store, chromosome)
+                if chromosome in old_chromosomes
+                else 0
+            )
+            for chromosome in chromosomes
+        }
+
+    with tempfile.TemporaryDirectory(
+        dir=Path(hdf_path).parent, prefix=".squire-"
+    ) as partition_dir:
+        partition_paths = {
+            chromosome: Path(partition_dir, f"{number}.h5")
+            for number, chromosome in enumerate(chromosomes)
+        }
+        order = sorted(chromosomes, key=sizes.__getitem__, reverse=True)
+        inserted = dict(
+            zip(
+                order,
+                map_partitions(
+                    workers,
+                    add_partition,
+                    [
+                        (
+                            hdf_path,
+                            partition_paths[chromosome],
+                            chromosome,
+                            bedmethyl_paths,
+                            dtypes,
+                            old_samples,
+                            carry_p_values,
+                            chunk_size,
+                        )
+                        for chromosome in order
+                    ],
+                ),
+                strict=True,
+            )
+        )
 
+        with pd.HDFStore(hdf_path, mode="a") as store:
+            for chromosome, partition_path in partition_paths.items():
+                key = f"{MERGED_GROUP}/{chromosome}"
+                copy_node(
+                    partition_path, key, store, f"merged_update/{chromosome}"
+                )
+                if not inserted[chromosome]:
+                    for sample in old_samples:
+                        store.get_node(
+                            get_sample_key(sample, chromosome)
+                        )._f_move(  # type: ignore[union-attr]
+                            newparent=f"/merged_update/{chromosome}/samples"
+                        )
+                if carry_p_values:
+                    copy_node(
+                        partition_path,
+                        get_stats_key(chromosome),
+                        store,
+                        get_stats_key(chromosome, "stats_update"),
+                    )
+                os.remove(partition_path)
+            attributes = get_attributes(store, "merged_update")
+            attributes.samples = old_samples + [
+                path.removeprefix("/data/") for path in bedmethyl_paths
+            ]
+            attributes.chromosomes = chromosomes
+            attributes.layout_version = LAYOUT_VERSION
 
-def add_to_merged_dataset(hdf_path: Path) -> None:
-    """Add newly parsed files in /data/ to merged_data in hdf5 file"""
-    with pd.HDFStore(hdf_path, mode="a") as store:
-        add_bedmethyls_to_merged_data(store, store["merged_data"])
+            replace_node(store, MERGED_GROUP, "merged_update")
+            # The p-values are sorted again once they are all computed
+            if SORTED_P_VALUES_KEY in store:
+                store.remove(SORTED_P_VALUES_KEY)
+            if carry_p_values:
+                replace_node(store, STATS_GROUP, "stats_update")
+                get_attributes(store, STATS_GROUP).samples = stats_samples
+            elif STATS_GROUP in store:
+                store.remove(STATS_GROUP)
+            if SUBSET_STATS_GROUP in store:
+                store.remove(SUBSET_STATS_GROUP)
+            for path in bedmethyl_paths:
+                store.remove(path)
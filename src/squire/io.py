@@ -1,8 +1,38 @@
+import operator
+from collections.abc import Iterator
+from contextlib import ExitStack, contextmanager
+from importlib.metadata import version
+from itertools import repeat
 from pathlib import Path
+from typing import TextIO
 
+import numpy as np
+import numpy.typing as npt
 import pandas as pd
 
+from squire.bgzf import BgzfChunk, BgzfWriter, compress_lines
+from squire.hdf5store import (
+    COORDINATE_COLUMNS,
+    LAYOUT_RELEASES,
+    LAYOUT_VERSION,
+    MERGED_GROUP,
+    STATS_GROUP,
+    find_stats,
+    get_attributes,
+    get_stats_key,
+    get_table,
+    select_rows,
+)
+from squire.parallel import WorkerPool, ordered_imap
+from squire.regions import get_row_ranges
 from squire.squire_exceptions import BedMethylReadError, HDFReadError
+from squire.stats import generate_batch
+from squire.types import CountMatrix, Regions, RowRanges
+
+# The whole and decimal parts of each percentage (formatted to 3 decimal
+# places), indexed by the number of whole percents and thousandths
+WHOLE_PERCENTAGES = np.array([str(percent) for percent in range(101)])
+THOUSANDTHS = np.array([f".{thousandth:03d}" for thousandth in range(1000)])
 
 
 def read_file_of_files(path: Path) -> list[Path]:
@@ -43,19 +73,12 @@ def make_viable_path(path: Path, exists_ok: bool = True) -> None:
         ) from e
 
 
-def validate_bedmethyl(
-    bedmethyl_path: Path, number_of_rows_to_check: int = 5
-) -> None:
-    """Validates the format of a bedmethyl file
-
-    Bedmethyl files have a specific format outlined by ONT's modkit. This
-    will attempt to verify whether a file fits said format.
+def validate_bedmethyl(bedmethyl_path: Path) -> None:
+    """Checks that a bedmethyl file exists and is not empty
 
-    Parameters
-    ---
-    number_of_rows_to_check: int
-        The number of rows to use when validating the file format. If the file
-        is malformed beyond these lines, this function will not report it.
+    Bedmethyl files have a specific format outlined by ONT's modkit. The
+    format of every line is validated as the file is parsed (see
+    `parse_chunk`), so the file is only opened once.
     """
     if not bedmethyl_path.exists():
         raise BedMethylReadError(f"{bedmethyl_path} does not exist.")
@@ -64,72 +87,209 @@ def validate_bedmethyl(
     if bedmethyl_path.stat().st_size == 0:
         raise BedMethylReadError(f"{bedmethyl_path} is empty.")
 
-    expected_dtypes = {
-        0: "str",  # chrom
-        1: "int64",  # start position
-        2: "int64",  # end position
-        3: "str",  # modified base code
-        4: "int64",  # score
-        5: "str",  # strand
-        6: "int64",  # start position
-        7: "int64",  # end position
-        8: "str",  # color
-        9: "int64",  # Nvalid_cov
-        10: "float64",  # fraction modified
-        11: "int64",  # Nmod
-        12: "int64",  # Ncanonical
-        13: "int64",  # Nother_mod
-        14: "int64",  # Ndelete
-        15: "int64",  # Nfail
-        16: "int64",  # Ndiff
-        17: "int64",  # Nnocall
-    }
-
-    try:
-        top_rows = pd.read_csv(
-            bedmethyl_path,
-            sep=r"\s+",
-            header=None,
-            nrows=number_of_rows_to_check,
-            dtype=expected_dtypes,  # type: ignore[arg-type]
-        )
-
-        if top_rows.shape[1] != 18:
-            raise BedMethylReadError(
-                f"{bedmethyl_path} does not have 18 fields.\n"
-                "Ensure that it was created by ONT's modkit"
-            )
-    except (ValueError, pd.errors.ParserError) as e:
-        raise BedMethylReadError(
-            f"Type conversion failed in {bedmethyl_path}. "
-            f"File may contain invalid values for expected types.\n"
-            f"Error: {str(e)}"
-        ) from e
-    except TypeError as e:
-        raise BedMethylReadError(
-            f"Invalid type specification while reading {bedmethyl_path}\n"
-            f"Error: {str(e)}"
-        ) from e
-    except Exception as e:
-        raise BedMethylReadError(
-            f"Unexpected error reading {bedmethyl_path}"
-        ) from e
-
 
 def validate_hdf5(hdf_path: Path) -> bool:
-    """Validates the format of a hdf5 file"""
+    """Validates the format of a hdf5 file
+
+    The file must have merged data in the layout that this version of SQUIRE
+    uses (see `LAYOUT_VERSION`). Files created before the layout version was
+    stored (by SQUIRE 0.1.x) have layout version 1.
+    """
     if not hdf_path.exists():
         raise HDFReadError(f"{hdf_path} does not exist.")
     if not hdf_path.is_file():
         raise HDFReadError(f"{hdf_path} is not a regular file.")
     try:
-        with pd.HDFStore(hdf_path, mode="r"):
+        with pd.HDFStore(hdf_path, mode="r") as store:
+            if MERGED_GROUP not in store:
+                raise HDFReadError(f"{hdf_path} does not contain merged data.")
+            layout_version = getattr(
+                get_attributes(store, MERGED_GROUP), "layout_version", 1
+            )
+            if layout_version != LAYOUT_VERSION:
+                created_by = LAYOUT_RELEASES.get(layout_version, "unknown")
+                raise HDFReadError(
+                    f"{hdf_path} has hdf5 layout version {layout_version} "
+                    f"(SQUIRE {created_by}), but SQUIRE {version('squire')} "
+                    f"reads layout version {LAYOUT_VERSION}. Recreate it "
+                    "with squire create."
+                )
             return True
     except OSError as e:
         raise HDFReadError(f"{hdf_path} is non-viable") from e
 
 
-def export_reference_matrix(hdf_path: Path, out_file_path: Path) -> None:
+def get_index_path(file_path: Path) -> Path:
+    """The path of the tabix index of a compressed output file"""
+    return file_path.with_name(file_path.name + ".tbi")
+
+
+@contextmanager
+def open_output(
+    file_path: Path, compress: bool = False
+) -> Iterator[TextIO | BgzfWriter]:
+    """Open a file to write lines of genomic loci to
+
+    Compressed files are BGZF compressed (as bgzip), and a tabix index of
+    the loci is written alongside them (see `get_index_path`). The lines
+    written to them must be compressed first (see `encode_lines`).
+    """
+    if not compress:
+        with open(file_path, "w") as out_file:
+            yield out_file
+        return
+    with open(file_path, "wb") as out_file:
+        writer = BgzfWriter(out_file, get_index_path(file_path))
+        yield writer
+        writer.finish()
+
+
+def encode_lines(
+    lines: str,
+    chromosome: str,
+    starts: npt.ArrayLike,
+    ends: npt.ArrayLike,
+    compress: bool = False,
+) -> str | BgzfChunk:
+    """Prepare lines of a chromosome's loci to be written (see `open_output`)
+
+    The starts and ends of the loci are only needed for compressed files,
+    where they are used to build the index.
+    """
+    if not compress:
+        return lines
+    return compress_lines(lines.encode(), chromosome, starts, ends)
+
+
+def write_chunk(out_file: TextIO | BgzfWriter, chunk: str | BgzfChunk) -> None:
+    """Write lines prepared by `encode_lines` to a file from `open_output`
+
+    Both must have been given the same value for compress.
+    """
+    if isinstance(out_file, BgzfWriter):
+        if not isinstance(chunk, BgzfChunk):
+            raise TypeError("Lines must be compressed for compressed files")
+        out_file.write(chunk)
+    elif isinstance(chunk, BgzfChunk):
+        raise TypeError("Compressed lines can't be written to plain files")
+    else:
+        out_file.write(chunk)
+
+
+def write_loci(
+    out_file: TextIO | BgzfWriter,
+    loci: pd.DataFrame,
+    chromosome: str,
+    compress: bool = False,
+) -> None:
+    """Write loci (chr, start, end, name) as tab separated lines"""
+    write_chunk(
+        out_file,
+        encode_lines(
+            loci[COORDINATE_COLUMNS].to_csv(
+                sep="\t", header=False, index=False
+            ),
+            chromosome,
+            loci["start"],
+            loci["end"],
+            compress,
+        ),
+    )
+
+
+def format_percentages(
+    modifications: CountMatrix, read_depths: CountMatrix
+) -> npt.NDArray[np.str_]:
+    """Format the percentage of reads with modifications to 3 decimal places
+
+    Gives the same strings as formatting modifications / read_depths * 100
+    with "%.3f", without formatting each float in python. The percentages are
+    rounded to integer thousandths, whose whole and decimal parts are looked
+    up from precomputed strings. The few percentages that are (almost)
+    exactly halfway between two thousandths, or above 100% (more
+    modifications than reads), are formatted with "%.3f" instead.
+    """
+    # Divided before multiplying (as the fractions were originally computed),
+    # which can change the last bit of the percentage and so how it rounds
+    percentages = (
+        np.divide(
+            modifications,
+            read_depths,
+            out=np.zeros(modifications.shape),
+            where=read_depths > 0,
+        )
+        * 100
+    )
+    thousandths = percentages * 1000
+    rounded = np.floor(thousandths + 0.5).astype(np.int64)
+    whole = rounded // 1000
+    above_100 = whole >= len(WHOLE_PERCENTAGES)
+    formatted = np.strings.add(
+        WHOLE_PERCENTAGES[np.where(above_100, 0, whole)],
+        THOUSANDTHS[rounded % 1000],
+    )
+    exceptions = above_100 | (
+        np.abs(thousandths - np.floor(thousandths) - 0.5) < 1e-6
+    )
+    formatted[exceptions] = [
+        f"{percentage:.3f}" for percentage in percentages[exceptions]
+    ]
+    return formatted
+
+
+def format_reference_chunk(
+    chromosome: str,
+    coordinates: pd.DataFrame,
+    modifications: CountMatrix,
+    read_depths: CountMatrix,
+    compress: bool = False,
+    subset: bool = False,
+) -> str | BgzfChunk:
+    """Format a chunk of merged data as lines of the reference matrix
+
+    Compressed chunks are also compressed here, so that this is done by the
+    workers (see `export_reference_matrix`). For a subset of the samples,
+    loci that none of the samples have reads for are left out.
+    """
+    if subset:
+        covered = (read_depths > 0).any(axis=1)
+        coordinates = coordinates.loc[covered]
+        modifications = modifications[covered]
+        read_depths = read_depths[covered]
+    loci = np.full(len(coordinates), chromosome)
+    for column in [
+        coordinates["start"].to_numpy().astype(str),
+        coordinates["end"].to_numpy().astype(str),
+        coordinates["name"].astype(str).to_numpy(),
+    ]:
+        loci = np.strings.add(np.strings.add(loci, "\t"), column)
+    # Joined by str.join over all rows, rather than row by row in python
+    lines = map(
+        operator.add,
+        np.strings.add(loci, "\t").tolist(),
+        map(
+            "\t".join,
+            format_percentages(modifications, read_depths).tolist(),
+        ),
+    )
+    return encode_lines(
+        "".join(map(operator.add, lines, repeat("\n"))),
+        chromosome,
+        coordinates["start"],
+        coordinates["end"],
+        compress,
+    )
+
+
+def export_reference_matrix(
+    hdf_path: Path,
+    out_file_path: Path,
+    workers: WorkerPool,
+    chunk_size: int = 100_000,
+    compress: bool = False,
+    regions: Regions | None = None,
+    samples: list[str] | None = None,
+) -> None:
     """Writes reference matrix to file from hdf5 file
 
     Reference matrix is a tab separated file with the columns:
@@ -141,25 +301,90 @@ def export_reference_matrix(hdf_path: Path, out_file_path: Path) -> None:
         - fraction modified cell type 2
         - ...
         - fraction modified cell type n
+
+    The merged data is streamed out one chromosome (and chunk of rows) at a
+    time, the chromosomes are stored in genomic order. Only the counts are
+    read, the fractions are derived from them as each chunk is formatted
+    (see `format_percentages`).
+
+    Parameters
+    ---
+    workers: WorkerPool
+        Chunks are read from the hdf5 file in this process and formatted (and
+        compressed) by the workers. The formatted chunks are written in order.
+    compress: bool
+        Whether to write a BGZF compressed, indexed file (see `open_output`)
+    regions: Regions | None
+        Only write the loci that overlap these regions (see `find_rows`)
+    samples: list[str] | None
+        Only write the fractions of these samples (in this order), only the
+        tables of these samples are read. Loci that none of these samples
+        have reads for are not written, which includes loci that are in
+        their bedmethyl files with a read depth of 0. So this is not always
+        the same as the reference matrix of a hdf5 file created from just
+        these samples, which keeps such loci.
     """
-    with pd.HDFStore(hdf_path, mode="r") as store:
-        merged = store["merged_data"]
-        fraction_columns = [
-            col for col in merged.columns if "_fraction" in col
+    with (
+        pd.HDFStore(hdf_path, mode="r") as store,
+        open_output(out_file_path, compress) as out_file,
+    ):
+        chunks = (
+            (chromosome, *batch, compress, samples is not None)
+            for chromosome, row_ranges in get_row_ranges(
+                store, regions
+            ).items()
+            for batch in generate_batch(
+                store, chromosome, chunk_size, row_ranges, samples
+            )
+        )
+        for lines in ordered_imap(workers, format_reference_chunk, chunks):
+            write_chunk(out_file, lines)
+
+
+def select_stats(
+    store: pd.HDFStore,
+    chromosome: str,
+    row_ranges: RowRanges,
+    where: str,
+    chunk_size: int,
+    group: str = STATS_GROUP,
+) -> Iterator[pd.DataFrame]:
+    """Query ranges of rows of a chromosome's stats, in chunks
+
+    The rows that match the query are found in each range first, so that
+    the matches of small ranges (e.g. many small regions) are read (and
+    written) together. The loci (start, end, name) and p-values of the
+    matches are read in chunks of chunk_size rows.
+    """
+    key = get_stats_key(chromosome, group)
+    rows = np.concatenate(
+        [
+            store.select_as_coordinates(
+                key, where, start=start, stop=stop
+            ).to_numpy()  # type: ignore[union-attr]
+            for start, stop in row_ranges
         ]
-        merged[fraction_columns].reset_index().to_csv(
-            out_file_path,
-            sep="\t",
-            float_format="%.3f",
-            header=False,
-            index=False,
+        or [np.empty(0, dtype=np.int64)]
+    )
+    for start in range(0, len(rows), chunk_size):
+        yield select_rows(
+            store,
+            key,
+            rows[start : start + chunk_size],
+            [*COORDINATE_COLUMNS[1:], "p_value"],
         )
 
 
 def export_cpg_list(
-    hdf_path: Path, out_file_path: Path, significance_threshold: float
+    hdf_path: Path,
+    out_file_paths: list[Path],
+    significance_thresholds: list[float],
+    chunk_size: int = 100_000,
+    compress: bool = False,
+    regions: Regions | None = None,
+    samples: list[str] | None = None,
 ) -> None:
-    """Writes a list of genomic loci that pass a significance theshold
+    """Writes lists of genomic loci that pass significance thresholds
 
     CpG list is a tab separated file with the columns:
         - chromosome
@@ -167,14 +392,158 @@ def export_cpg_list(
         - end
         - name(m/h)
 
+    One CpG list is written for each threshold, in a single pass over the
+    stats. The largest threshold is queried against the p-value index of
+    each chromosome's stats (see `index_stats`), so only the loci that pass
+    it are read. Each chunk of these is then split between the CpG lists,
+    which are written out in genomic order.
+
     Parameters
     ---
-    significance_threshold: float
-        The threshold by which the genomic loci are filtered on
+    out_file_paths: list[Path]
+        The file to write the CpG list of each threshold to
+    significance_thresholds: list[float]
+        The thresholds by which the genomic loci are filtered on
+    compress: bool
+        Whether to write BGZF compressed, indexed files (see `open_output`)
+    regions: Regions | None
+        Only write the loci that overlap these regions (see `find_rows`),
+        only the rows of these loci are queried
+    samples: list[str] | None
+        Use the p-values computed against a subset of the samples (see
+        `find_stats`)
     """
-    with pd.HDFStore(hdf_path, mode="r") as store:
-        cpg_list = store["stats"]
-        cpg_list = cpg_list[cpg_list["p_value"] < significance_threshold]
-        cpg_list[["chr", "start", "end", "name"]].to_csv(
-            out_file_path, sep="\t", header=False, index=False
-        )
+    # p-values are between 0 and 1, clipping keeps the threshold finite (the
+    # query can't be given infinity)
+    largest_threshold = min(max(max(significance_thresholds), -1.0), 2.0)
+    with (
+        pd.HDFStore(hdf_path, mode="r") as store,
+        ExitStack() as out_files,
+    ):
+        group = find_stats(store, samples)
+        out_files_by_threshold = [
+            (
+                threshold,
+                out_files.enter_context(open_output(out_file_path, compress)),
+            )
+            for out_file_path, threshold in zip(
+                out_file_paths, significance_thresholds, strict=True
+            )
+        ]
+        for chromosome, row_ranges in get_row_ranges(store, regions).items():
+            for cpg_list in select_stats(
+                store,
+                chromosome,
+                row_ranges,
+                f"p_value < {largest_threshold!r}",
+                chunk_size,
+                group,
+            ):
+                cpg_list.insert(0, "chr", chromosome)
+                for threshold, out_file in out_files_by_threshold:
+                    write_loci(
+                        out_file,
+                        cpg_list.loc[cpg_list["p_value"] < threshold],
+                        chromosome,
+                        compress,
+                    )
+
+
+def keep_smallest(
+    p_values: npt.NDArray[np.float64], count: int
+) -> npt.NDArray[np.bool_]:
+    """Mask of the `count` smallest p-values (NaN being the largest)
+
+    Found with a partial sort (np.partition). Ties at the cut off are broken
+    by position, the first p-values are kept.
+    """
+    p_values = np.nan_to_num(p_values, nan=np.inf)
+    if len(p_values) <= count:
+        return np.ones(len(p_values), dtype=bool)
+    cut_off = np.partition(p_values, count - 1)[count - 1]
+    keep = p_values < cut_off
+    ties = np.flatnonzero(p_values == cut_off)
+    keep[ties[: count - np.count_nonzero(keep)]] = True
+    return keep
+
+
+def select_top_loci(
+    store: pd.HDFStore,
+    count: int,
+    chunk_size: int,
+    row_ranges: dict[str, RowRanges],
+    group: str = STATS_GROUP,
+) -> dict[str, npt.NDArray[np.int64]]:
+    """Find the `count` loci with the smallest p-values
+
+    The p-values of each chromosome are streamed in chunks (in genomic
+    order), and only the best `count` loci seen so far are kept (see
+    `keep_smallest`), so memory use does not depend on the size of the
+    genome. The loci are kept in genomic order, so ties are broken in favour
+    of the earliest loci.
+
+    Only the p-values in the ranges of rows of each chromosome are read (see
+    `get_row_ranges`). Returns the (ascending) rows of the stats table of
+    each chromosome.
+    """
+    chromosomes = list(row_ranges)
+    best_p_values = np.empty(0, dtype=np.float64)
+    best_chromosomes = np.empty(0, dtype=np.int64)
+    best_rows = np.empty(0, dtype=np.int64)
+    for number, chromosome in enumerate(chromosomes):
+        table = get_table(store, get_stats_key(chromosome, group))
+        for start, stop in (
+            (start, min(start + chunk_size, range_stop))
+            for range_start, range_stop in row_ranges[chromosome]
+            for start in range(range_start, range_stop, chunk_size)
+        ):
+            best_p_values = np.concatenate(
+                [best_p_values, table.read(start, stop, field="p_value")]
+            )
+            best_chromosomes = np.concatenate(
+                [best_chromosomes, np.full(stop - start, number)]
+            )
+            best_rows = np.concatenate([best_rows, np.arange(start, stop)])
+            keep = keep_smallest(best_p_values, count)
+            best_p_values = best_p_values[keep]
+            best_chromosomes = best_chromosomes[keep]
+            best_rows = best_rows[keep]
+    return {
+        chromosome: best_rows[best_chromosomes == number]
+        for number, chromosome in enumerate(chromosomes)
+    }
+
+
+def export_top_cpg_list(
+    hdf_path: Path,
+    out_file_path: Path,
+    count: int,
+    chunk_size: int = 100_000,
+    compress: bool = False,
+    regions: Regions | None = None,
+    samples: list[str] | None = None,
+) -> None:
+    """Writes the `count` genomic loci with the smallest p-values
+
+    The CpG list has the same format as `export_cpg_list`, and is in genomic
+    order. If loci are tied at the cut off, the earliest are written. If
+    regions are given, only the loci that overlap them are considered. If
+    samples are given, the p-values computed against them are used.
+    """
+    with (
+        pd.HDFStore(hdf_path, mode="r") as store,
+        open_output(out_file_path, compress) as out_file,
+    ):
+        group = find_stats(store, samples)
+        for chromosome, rows in select_top_loci(
+            store, count, chunk_size, get_row_ranges(store, regions), group
+        ).items():
+            for start in range(0, len(rows), chunk_size):
+                cpg_list = select_rows(
+                    store,
+                    get_stats_key(chromosome, group),
+                    rows[start : start + chunk_size],
+                    COORDINATE_COLUMNS[1:],
+                )
+                cpg_list.insert(0, "chr", chromosome)
+                write_loci(out_file, cpg_list, chromosome, compress)
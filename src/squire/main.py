@@ -1,86 +1,128 @@
 import os
+from dataclasses import replace
+from pathlib import Path
 
 from squire.hdf5store import (
-    add_file_to_hdf_store,
+    add_files_to_hdf_store,
     add_to_merged_dataset,
+    check_new_samples,
     create_merged_dataset,
-    generate_coordinate_index,
 )
 from squire.io import (
     export_cpg_list,
     export_reference_matrix,
+    export_top_cpg_list,
+    get_index_path,
     make_viable_path,
     read_file_of_files,
     validate_bedmethyl,
     validate_hdf5,
 )
+from squire.parallel import WorkerPool, create_worker_pool
+from squire.regions import get_regions
 from squire.reports import pvalue_threshold_report
+from squire.shards import get_shard_chromosomes, merge_shards
 from squire.squire_exceptions import SquireError
-from squire.stats import compute_p_values
-from squire.types import CpGListArgs, CreateArgs, ReferenceArgs, ReportArgs
+from squire.stats import compute_p_values, update_p_values
+from squire.types import (
+    CpGListArgs,
+    CreateArgs,
+    MergeShardsArgs,
+    ReferenceArgs,
+    ReportArgs,
+    StatsArgs,
+)
 
 
-def add_bedmethyl_list_to_hdf_data(args: CreateArgs) -> None:
-    """Adds bedmethyl files to a hdf5 file"""
+def get_bedmethyl_list(args: CreateArgs) -> list[Path]:
+    """Get the bedmethyl files given (directly or with a file of files)"""
     file_list = (
         read_file_of_files(args.file)
         if args.file is not None
         else args.bedmethyl_list
     )
     assert file_list is not None
+    return file_list
+
 
+def add_bedmethyl_list_to_hdf_data(
+    args: CreateArgs, workers: WorkerPool
+) -> None:
+    """Adds bedmethyl files to a hdf5 file (parsing them in parallel)"""
+    file_list = get_bedmethyl_list(args)
     for bedmethyl in file_list:
         validate_bedmethyl(bedmethyl)
-        add_file_to_hdf_store(bedmethyl, args.hdf5)
+    add_files_to_hdf_store(file_list, args.hdf5, workers, args.chromosomes)
 
 
 def create_hdf(args: CreateArgs) -> None:
     """Intialise hdf5 file for other commands to read from
 
     Uses a list of bedmethyl files (list can be generated from a file of files)
-    to create a hdf5 file that contains the following information:
-      - A merged pandas dataframe of each input bedmethyl file, keeping the
-        columns:
-          - chromosome
-          - start
-          - end
-          - name(m/h)
-          - read depth
-          - number of modifications
-          - raction of reads with modifications
-      - A pandas dataframe containing the p-values for each position,
-        describing how different the underlying distributions of each cell
-        type is for that genomic locus.
+    to create a hdf5 file that is partitioned by chromosome (see
+    `create_merged_dataset`) and contains the following information:
+      - merged/<chromosome>/coordinates: the loci of every input bedmethyl
+        file (start and end as uint32, and name(m/h)) in genomic order.
+      - merged/<chromosome>/samples/<sample>: the read depth and number of
+        modifications of each sample at these loci (0 where a sample has no
+        reads), as the smallest unsigned integer type that holds every count
+        (uint16 or uint32). The fraction of reads with modifications is not
+        stored, it is derived from the counts when it is needed.
+      - stats/<chromosome>: the p-value of each locus, describing how
+        different the underlying distributions of each cell type are for
+        that genomic locus, and sorted_p_values: every p-value in ascending
+        order (see `compute_p_values`).
+    The tables of a chromosome are aligned by row. The samples, chromosomes
+    and layout version are stored as attributes of the merged group.
 
     Timing
     ---
-    With 2 9GB files, this takes ~40 minutes to add and merge the files and
-    another hour to compute all of the p-values (~2.5 million).
-        - File reading and merging is single threaded and so should be mainly
-          dependent on the number and size of the files being used.
-        - pvalue calculations are processed in parallel. This timing was taken
-          from a 'Intel(R) Xeon(R) CPU E5-2640 v3 @ 2.60GHz' processor
+        - Files are split into chunks that are parsed in parallel, but are
+          written to the hdf5 file one at a time. Each chromosome is merged
+          in parallel (with process workers), so merging scales with the
+          number of workers up to the number of chromosomes.
+        - pvalue calculations are processed in parallel.
+        - The number of workers is set with --jobs, and a single pool of
+          workers is kept for the whole run.
+        - With --shard, only some of the chromosomes are processed (see
+          `get_shard_chromosomes`), so the work can be split between jobs.
     """
     try:
         make_viable_path(args.hdf5, args.overwrite)
         if args.overwrite and os.path.exists(args.hdf5):
             os.remove(args.hdf5)
-        add_bedmethyl_list_to_hdf_data(args)
-        generate_coordinate_index(args.hdf5)
-        create_merged_dataset(args.hdf5)
-        compute_p_values(args.hdf5)
+        if args.shard is not None:
+            file_list = get_bedmethyl_list(args)
+            for bedmethyl in file_list:
+                validate_bedmethyl(bedmethyl)
+            args = replace(
+                args,
+                chromosomes=get_shard_chromosomes(
+                    file_list, *args.shard, args.chromosomes
+                ),
+            )
+        with create_worker_pool(args.jobs, args.backend) as workers:
+            add_bedmethyl_list_to_hdf_data(args, workers)
+            create_merged_dataset(args.hdf5, workers, args.chunk_size)
+            compute_p_values(args.hdf5, workers, args.chunk_size)
 
     except (PermissionError, FileExistsError) as e:
         raise SquireError(f"SQUIRE failed to create {args.hdf5}.") from e
 
 
 def add_to_hdf(args: CreateArgs) -> None:
-    """Add to the hdf5 file and recalculate statistics"""
+    """Add to the hdf5 file and recalculate statistics
+
+    Only the p-values of loci that the new files have reads for are
+    recomputed (see `add_to_merged_dataset` and `update_p_values`).
+    """
     try:
         validate_hdf5(args.hdf5)
-        add_bedmethyl_list_to_hdf_data(args)
-        add_to_merged_dataset(args.hdf5)
-        compute_p_values(args.hdf5)
+        check_new_samples(args.hdf5, get_bedmethyl_list(args))
+        with create_worker_pool(args.jobs, args.backend) as workers:
+            add_bedmethyl_list_to_hdf_data(args, workers)
+            add_to_merged_dataset(args.hdf5, workers, args.chunk_size)
+            update_p_values(args.hdf5, workers, args.chunk_size)
     except (PermissionError, FileExistsError) as e:
         raise SquireError(f"SQUIRE failed to update {args.hdf5}") from e
 
@@ -94,23 +136,67 @@ def write_reference_matrix(args: ReferenceArgs) -> None:
     try:
         validate_hdf5(args.hdf5)
         make_viable_path(args.out_path, args.overwrite)
-        export_reference_matrix(args.hdf5, args.out_path)
+        if args.bgzip:
+            make_viable_path(get_index_path(args.out_path), args.overwrite)
+        with create_worker_pool(args.jobs, args.backend) as workers:
+            export_reference_matrix(
+                args.hdf5,
+                args.out_path,
+                workers,
+                args.chunk_size,
+                args.bgzip,
+                get_regions(args.hdf5, args.regions, args.chromosomes),
+                args.samples,
+            )
     except (PermissionError, FileExistsError) as e:
         raise SquireError(f"SQUIRE failed to write to {args.out_path}") from e
 
 
 def write_cpg_list(args: CpGListArgs) -> None:
-    """Write a CpG list (for HyLoRD) using a hdf5 file
+    """Write CpG lists (for HyLoRD) using a hdf5 file
 
     This is a wrapper for the `export_cpg_list` function, it tests file
-    viability before writing to the given path
+    viability before writing to the given paths (one for each threshold)
     """
+    if args.top is not None and len(args.out_paths) != 1:
+        raise SquireError("--top writes a single CpG list, give one out_path")
+    if args.top is None and len(args.out_paths) != len(args.thresholds):
+        raise SquireError(
+            f"{len(args.thresholds)} thresholds were given for "
+            f"{len(args.out_paths)} out_paths, give one threshold for each "
+            "CpG list."
+        )
+    if len(set(args.out_paths)) != len(args.out_paths):
+        raise SquireError("Each CpG list needs a different out_path")
     try:
         validate_hdf5(args.hdf5)
-        make_viable_path(args.out_path, args.overwrite)
-        export_cpg_list(args.hdf5, args.out_path, args.threshold)
+        for out_path in args.out_paths:
+            make_viable_path(out_path, args.overwrite)
+            if args.bgzip:
+                make_viable_path(get_index_path(out_path), args.overwrite)
+        regions = get_regions(args.hdf5, args.regions, args.chromosomes)
+        if args.top is not None:
+            export_top_cpg_list(
+                args.hdf5,
+                args.out_paths[0],
+                args.top,
+                compress=args.bgzip,
+                regions=regions,
+                samples=args.samples,
+            )
+        else:
+            export_cpg_list(
+                args.hdf5,
+                args.out_paths,
+                args.thresholds,
+                compress=args.bgzip,
+                regions=regions,
+                samples=args.samples,
+            )
     except (PermissionError, FileExistsError) as e:
-        raise SquireError(f"SQUIRE failed to write to {args.out_path}") from e
+        raise SquireError(
+            f"SQUIRE failed to write to {','.join(map(str, args.out_paths))}"
+        ) from e
 
 
 def print_threshold_analysis(args: ReportArgs) -> None:
@@ -122,7 +208,43 @@ def print_threshold_analysis(args: ReportArgs) -> None:
     try:
         validate_hdf5(args.hdf5)
         pvalue_threshold_report(
-            args.hdf5, args.thresholds, args.machine_parsable
+            args.hdf5,
+            args.thresholds,
+            args.machine_parsable,
+            get_regions(args.hdf5, args.regions, args.chromosomes),
+            args.samples,
         )
     except (PermissionError, FileExistsError) as e:
         raise SquireError("SQUIRE failed to report threshold analysis") from e
+
+
+def compute_stats(args: StatsArgs) -> None:
+    """Compute p-values (for a subset of the samples) in a hdf5 file
+
+    This is a wrapper for the `compute_p_values` function, it tests for hdf5
+    file viability before running the function. The p-values of a subset
+    of the samples are kept alongside those of every sample.
+    """
+    if args.samples is not None and len(args.samples) < 2:
+        raise SquireError("At least two samples are needed for p-values.")
+    try:
+        validate_hdf5(args.hdf5)
+        with create_worker_pool(args.jobs, args.backend) as workers:
+            compute_p_values(args.hdf5, workers, args.chunk_size, args.samples)
+    except PermissionError as e:
+        raise SquireError(f"SQUIRE failed to update {args.hdf5}") from e
+
+
+def merge_shard_files(args: MergeShardsArgs) -> None:
+    """Combine the hdf5 files of each shard (see `squire create --shard`)
+
+    This is a wrapper for the `merge_shards` function, it tests file
+    viability before writing to the given path
+    """
+    try:
+        for shard in args.shards:
+            validate_hdf5(shard)
+        make_viable_path(args.hdf5, args.overwrite)
+        merge_shards(args.hdf5, args.shards)
+    except (PermissionError, FileExistsError) as e:
+        raise SquireError(f"SQUIRE failed to create {args.hdf5}.") from e
@@ -0,0 +1,165 @@
+import math
+import multiprocessing
+import os
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from dataclasses import dataclass
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from types import TracebackType
+from typing import Self
+
+import numpy as np
+import numpy.typing as npt
+
+from squire.types import Backend
+
+
+def available_cpus() -> int:
+    """Number of CPUs this process is allowed to run on
+
+    Respects CPU affinity (e.g. cgroup/Slurm/PBS allocations) where the
+    platform supports it, rather than counting every CPU on the node.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+@dataclass
+class WorkerPool:
+    """The worker pool used for the lifetime of a squire command
+
+    Attributes
+    ---
+    executor: Executor
+        The pool that work is submitted to.
+    jobs: int
+        The number of workers in the pool.
+    backend: "process" | "thread"
+        Threads avoid the cost of starting processes and of copying data to
+        them, and work well for the vectorised numpy kernels (which release
+        the GIL). Processes sidestep the GIL entirely, data is handed to them
+        through shared memory (see `SharedArray`).
+    """
+
+    executor: Executor
+    jobs: int
+    backend: Backend
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.executor.shutdown()
+
+
+def create_worker_pool(jobs: int, backend: Backend) -> WorkerPool:
+    """Create a pool of `jobs` process or thread workers"""
+    if backend == "thread":
+        return WorkerPool(ThreadPoolExecutor(max_workers=jobs), jobs, backend)
+    # Workers must share this process' resource tracker, otherwise each one
+    # would try to clean up the shared memory it attaches to when it exits
+    resource_tracker.ensure_running()
+    # Workers are started from a clean server process rather than forked from
+    # this one, so that they don't inherit open hdf5 files (and their locks)
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(
+        ["squire.bedmethyl", "squire.io", "squire.stats"]
+    )
+    return WorkerPool(
+        ProcessPoolExecutor(max_workers=jobs, mp_context=context),
+        jobs,
+        backend,
+    )
+
+
+def ordered_imap[T](
+    workers: WorkerPool,
+    function: Callable[..., T],
+    arguments: Iterable[tuple],
+    window: int | None = None,
+) -> Iterator[T]:
+    """Lazily apply function to each tuple of arguments using the workers
+
+    Results are yielded in the order of the arguments. At most `window`
+    (default: twice the number of workers) tasks are submitted ahead of the
+    result being consumed, which bounds the memory held by pending results.
+    """
+    window = window or workers.jobs * 2
+    pending: deque[Future[T]] = deque()
+    for argument in arguments:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(workers.executor.submit(function, *argument))
+    while pending:
+        yield pending.popleft().result()
+
+
+class SharedArray:
+    """A numpy array stored in shared memory
+
+    Pickling a SharedArray only sends the name of the shared memory block,
+    the shape and the dtype, so worker processes attach to the same memory
+    instead of receiving (and holding) their own copy of the data.
+
+    The process that creates the array owns it and unlinks the shared memory
+    on `close`. Workers should also `close` the array once they are done.
+    """
+
+    def __init__(
+        self,
+        shape: tuple[int, ...],
+        dtype: npt.DTypeLike,
+        name: str | None = None,
+    ) -> None:
+        self._owner = name is None
+        self._shape = shape
+        self._dtype = np.dtype(dtype)
+        size = max(1, math.prod(shape) * self._dtype.itemsize)
+        self._memory = SharedMemory(name=name, create=self._owner, size=size)
+        self.array: npt.NDArray = np.ndarray(
+            shape, dtype=self._dtype, buffer=self._memory.buf
+        )
+
+    @classmethod
+    def from_array(cls, array: npt.NDArray) -> Self:
+        """Create a shared copy of an existing array"""
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    def __reduce__(
+        self,
+    ) -> tuple[type[Self], tuple[tuple[int, ...], np.dtype, str]]:
+        return (type(self), (self._shape, self._dtype, self._memory.name))
+
+    def close(self) -> None:
+        """Detach from (and, if the owner, free) the shared memory"""
+        del self.array
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
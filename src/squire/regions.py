@@ -0,0 +1,164 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from squire.hdf5store import (
+    get_chromosomes,
+    get_coordinates_key,
+    get_max_span,
+    get_merged_row_count,
+    get_table,
+)
+from squire.squire_exceptions import RegionsReadError
+from squire.types import Regions, RowRanges
+
+# Loci are stored with uint32 positions, so this covers a whole chromosome
+WHOLE_CHROMOSOME = (0, 2**32)
+
+
+def merge_intervals(intervals: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Sort intervals, merging those that overlap or touch"""
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        elif start < end:
+            merged.append((start, end))
+    return merged
+
+
+def read_regions(file_path: Path) -> Regions:
+    """Read the regions of a BED file
+
+    Only the first three columns (chromosome, start, end) are used, and
+    browser/track/comment lines are skipped. The regions of each chromosome
+    are sorted, and regions that overlap are merged.
+    """
+    if not file_path.is_file():
+        raise RegionsReadError(f"{file_path} does not exist.")
+    intervals: dict[str, list[tuple[int, int]]] = {}
+    with open(file_path) as regions_file:
+        for line_number, line in enumerate(regions_file, start=1):
+            if not line.strip() or line.startswith(("#", "browser", "track")):
+                continue
+            fields = line.split()
+            try:
+                start, end = int(fields[1]), int(fields[2])
+            except (IndexError, ValueError) as e:
+                raise RegionsReadError(
+                    f"{file_path} is malformed at line {line_number}: "
+                    "expected chromosome, start and end columns"
+                ) from e
+            if not 0 <= start <= end:
+                raise RegionsReadError(
+                    f"{file_path} is malformed at line {line_number}: "
+                    f"{start}-{end} is not a valid region"
+                )
+            intervals.setdefault(fields[0], []).append((start, end))
+    return {
+        chromosome: merge_intervals(chromosome_intervals)
+        for chromosome, chromosome_intervals in intervals.items()
+    }
+
+
+def get_regions(
+    hdf_path: Path, regions_path: Path | None, chromosomes: list[str] | None
+) -> Regions | None:
+    """Combine a regions file and a list of chromosomes into regions
+
+    Chromosomes without a regions file are selected whole. If both are
+    given, only the regions on the chromosomes are kept. Returns None if
+    neither are given (everything is selected).
+
+    Every chromosome given must be in the hdf5 file. Regions on chromosomes
+    that are not in the hdf5 file are left out, but at least one chromosome
+    of the regions file must be in the hdf5 file (to catch naming
+    mismatches like 1 and chr1).
+    """
+    if regions_path is None and chromosomes is None:
+        return None
+    with pd.HDFStore(hdf_path, mode="r") as store:
+        store_chromosomes = get_chromosomes(store)
+    for chromosome in chromosomes or []:
+        if chromosome not in store_chromosomes:
+            raise RegionsReadError(
+                f"{chromosome} is not a chromosome in {hdf_path}. The "
+                f"chromosomes are {','.join(store_chromosomes)}."
+            )
+    if regions_path is None:
+        return {
+            chromosome: [WHOLE_CHROMOSOME] for chromosome in chromosomes or []
+        }
+    regions = read_regions(regions_path)
+    if not any(chromosome in store_chromosomes for chromosome in regions):
+        raise RegionsReadError(
+            f"None of the chromosomes in {regions_path} are in {hdf_path}. "
+            f"The chromosomes are {','.join(store_chromosomes)}."
+        )
+    return {
+        chromosome: intervals
+        for chromosome, intervals in regions.items()
+        if chromosome in store_chromosomes
+        and (chromosomes is None or chromosome in chromosomes)
+    }
+
+
+def find_rows(
+    store: pd.HDFStore, chromosome: str, intervals: list[tuple[int, int]]
+) -> RowRanges:
+    """Find the rows of the loci of a chromosome that overlap intervals
+
+    The loci are sorted by their start (the coordinates table), so the start
+    column is read once and the rows of every interval are found with a
+    single (vectorised) binary search of it. Loci that start before an
+    interval overlap it if they are long enough, up to the longest locus of
+    the chromosome (see `index_coordinates`), so only these few loci have
+    their ends read.
+
+    The intervals must be sorted and not overlap (see `merge_intervals`).
+    """
+    table = get_table(store, get_coordinates_key(chromosome))
+    starts = table.read(field="start")
+    max_span = get_max_span(store, chromosome)
+    interval_starts, interval_ends = np.array(
+        intervals, dtype=np.int64
+    ).reshape(-1, 2).T
+    firsts = np.searchsorted(starts, interval_starts - max_span + 1)
+    overlap_starts = np.searchsorted(starts, interval_starts)
+    stops = np.searchsorted(starts, interval_ends)
+    row_ranges = list(
+        zip(overlap_starts.tolist(), stops.tolist(), strict=True)
+    )
+    before = firsts < overlap_starts
+    if before.any():
+        # The rows from first to overlap start of each of these intervals
+        lengths = (overlap_starts - firsts)[before]
+        offsets = np.arange(lengths.sum()) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        rows = np.repeat(firsts[before], lengths) + offsets
+        ends = table.read_coordinates(rows, field="end")
+        overlapping = rows[ends > np.repeat(interval_starts[before], lengths)]
+        row_ranges.extend((row, row + 1) for row in overlapping.tolist())
+    return merge_intervals(row_ranges)
+
+
+def get_row_ranges(
+    store: pd.HDFStore, regions: Regions | None
+) -> dict[str, RowRanges]:
+    """Find the rows of each chromosome to read for regions
+
+    Chromosomes are in the same order as the store. Every row is selected
+    if regions is None, and chromosomes without regions are left out.
+    """
+    if regions is None:
+        return {
+            chromosome: [(0, get_merged_row_count(store, chromosome))]
+            for chromosome in get_chromosomes(store)
+        }
+    return {
+        chromosome: find_rows(store, chromosome, regions[chromosome])
+        for chromosome in get_chromosomes(store)
+        if chromosome in regions
+    }
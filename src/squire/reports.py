@@ -2,19 +2,38 @@ from pathlib import Path
 
 import pandas as pd
 
+from squire.hdf5store import count_p_values_below, find_stats
+from squire.regions import get_row_ranges
+from squire.types import Regions
+
 
 def pvalue_threshold_report(
-    hdf_file: Path, threshold_list: list[float], machine_parsable: bool
+    hdf_file: Path,
+    threshold_list: list[float],
+    machine_parsable: bool,
+    regions: Regions | None = None,
+    samples: list[str] | None = None,
 ) -> None:
-    """Print number of genomic loci that pass a certain pvalue threshold"""
+    """Print number of genomic loci that pass a certain pvalue threshold
+
+    The counts come from a binary search of the sorted p-values, so the
+    stats tables are not read. If regions are given, only the loci that
+    overlap them are counted, which reads the p-values of these loci. If
+    samples are given, the p-values computed against them are used (see
+    `find_stats`).
+    """
     with pd.HDFStore(hdf_file, mode="r") as store:
-        stats = store["stats"]
-        for threshold in threshold_list:
-            n_rows = sum(stats["p_value"] < threshold)
-            if machine_parsable:
-                print(f"{threshold}:{n_rows}")
-            else:
-                print(
-                    f"If you use a threshold of {threshold}: "
-                    f"{n_rows} cpgs will remain."
-                )
+        counts = count_p_values_below(
+            store,
+            threshold_list,
+            None if regions is None else get_row_ranges(store, regions),
+            find_stats(store, samples),
+        )
+    for threshold, n_rows in zip(threshold_list, counts, strict=True):
+        if machine_parsable:
+            print(f"{threshold}:{n_rows}")
+        else:
+            print(
+                f"If you use a threshold of {threshold}: "
+                f"{n_rows} cpgs will remain."
+            )
@@ -0,0 +1,125 @@
+from pathlib import Path
+
+import pandas as pd
+
+from squire.bedmethyl import get_chromosome_sizes
+from squire.hdf5store import (
+    LAYOUT_VERSION,
+    MERGED_GROUP,
+    STATS_GROUP,
+    check_chromosomes_found,
+    copy_node,
+    get_attributes,
+    get_chromosomes,
+    get_sample_names,
+    get_stats_key,
+    has_stats,
+    write_sorted_p_values,
+)
+from squire.sorting import chromosome_sorter
+from squire.squire_exceptions import HDFReadError, SquireError
+
+
+def assign_shards(sizes: dict[str, int], shard_count: int) -> list[list[str]]:
+    """Split chromosomes into shards with roughly the same amount of data
+
+    The largest chromosomes are assigned first, each to the shard with the
+    least data so far. The assignment only depends on the sizes, so every
+    shard (e.g. each task of an array job) computes the same assignment.
+    """
+    shards: list[list[str]] = [[] for _ in range(shard_count)]
+    loads = [0 for _ in range(shard_count)]
+    for chromosome in sorted(
+        sizes,
+        key=lambda chromosome: (
+            -sizes[chromosome],
+            chromosome_sorter(chromosome),
+        ),
+    ):
+        smallest = loads.index(min(loads))
+        shards[smallest].append(chromosome)
+        loads[smallest] += sizes[chromosome]
+    return [sorted(shard, key=chromosome_sorter) for shard in shards]
+
+
+def get_shard_chromosomes(
+    file_paths: list[Path],
+    shard: int,
+    shard_count: int,
+    chromosomes: list[str] | None = None,
+) -> list[str]:
+    """Get the chromosomes that a shard (1 to shard_count) should process
+
+    Chromosomes are balanced between shards by their size in the bedmethyl
+    files (see `get_chromosome_sizes`). If chromosomes are given, only
+    these are split between the shards, and they must all be in the files.
+    """
+    sizes: dict[str, int] = {}
+    for file_path in file_paths:
+        for chromosome, size in get_chromosome_sizes(file_path).items():
+            sizes[chromosome] = sizes.get(chromosome, 0) + size
+    if chromosomes is not None:
+        check_chromosomes_found(sizes, chromosomes)
+        sizes = {
+            chromosome: size
+            for chromosome, size in sizes.items()
+            if chromosome in chromosomes
+        }
+    shard_chromosomes = assign_shards(sizes, shard_count)[shard - 1]
+    if not shard_chromosomes:
+        raise SquireError(
+            f"There are only {len(sizes)} chromosomes, which is not enough "
+            f"for shard {shard} of {shard_count}. Use fewer shards."
+        )
+    return shard_chromosomes
+
+
+def merge_shards(hdf_path: Path, shard_paths: list[Path]) -> None:
+    """Combine hdf5 files created with `squire create --shard` into one
+
+    Each shard holds the merged data and p-values of different chromosomes
+    for the same samples, so the partitions (see `create_merged_dataset`)
+    are copied into the new hdf5 file as they are. Nothing is recomputed.
+
+    Every shard is checked before anything is copied.
+    """
+    samples: list[str] | None = None
+    shard_chromosomes: dict[str, Path] = {}
+    for shard_path in shard_paths:
+        with pd.HDFStore(shard_path, mode="r") as shard:
+            if samples is None:
+                samples = get_sample_names(shard)
+            elif get_sample_names(shard) != samples:
+                raise HDFReadError(
+                    f"{shard_path} has different samples "
+                    f"({','.join(get_sample_names(shard))}) to "
+                    f"{shard_paths[0]} ({','.join(samples)})."
+                )
+            if not has_stats(shard) or list(
+                get_attributes(shard, STATS_GROUP).samples
+            ) != get_sample_names(shard):
+                raise HDFReadError(
+                    f"{shard_path} does not have p-values for all samples."
+                )
+            for chromosome in get_chromosomes(shard):
+                if chromosome in shard_chromosomes:
+                    raise HDFReadError(
+                        f"{chromosome} is in both "
+                        f"{shard_chromosomes[chromosome]} and {shard_path}."
+                    )
+                shard_chromosomes[chromosome] = shard_path
+
+    with pd.HDFStore(hdf_path, mode="w") as store:
+        chromosomes = sorted(shard_chromosomes, key=chromosome_sorter)
+        for chromosome in chromosomes:
+            for key in (
+                f"{MERGED_GROUP}/{chromosome}",
+                get_stats_key(chromosome),
+            ):
+                copy_node(shard_chromosomes[chromosome], key, store, key)
+        attributes = get_attributes(store, MERGED_GROUP)
+        attributes.samples = samples
+        attributes.chromosomes = chromosomes
+        attributes.layout_version = LAYOUT_VERSION
+        get_attributes(store, STATS_GROUP).samples = samples
+        write_sorted_p_values(store)
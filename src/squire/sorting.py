@@ -1,3 +1,14 @@
+import numpy as np
+import numpy.typing as npt
+
+# Loci of a chromosome are packed into a single uint64 key: the start in the
+# top 32 bits, then the length (end - start) and the modification code
+# (name) in 16 bits each. Keys sort by start, end and then name.
+SPAN_BITS = 16
+NAME_BITS = 16
+MAX_SPAN = 2**SPAN_BITS - 1
+
+
 def chromosome_sorter(chromosome: str) -> tuple[int, int] | tuple[int, str]:
     if chromosome.startswith("chr"):
         num_part = chromosome[3:]
@@ -7,3 +18,36 @@ def chromosome_sorter(chromosome: str) -> tuple[int, int] | tuple[int, str]:
             return (1, num_part)
     else:
         return (2, chromosome)
+
+
+def pack_loci(
+    starts: npt.ArrayLike, ends: npt.ArrayLike, names: npt.ArrayLike
+) -> npt.NDArray[np.uint64]:
+    """Pack the loci of a chromosome into keys that sort in genomic order
+
+    names are the (integer) codes of the modification codes. Keys can be
+    sorted, deduplicated (np.unique) and aligned (np.searchsorted) as plain
+    integers rather than as (start, end, name) tuples.
+    """
+    starts = np.asarray(starts, dtype=np.uint64)
+    spans = np.asarray(ends, dtype=np.uint64) - starts
+    return (
+        (starts << np.uint64(SPAN_BITS + NAME_BITS))
+        | (spans << np.uint64(NAME_BITS))
+        | np.asarray(names, dtype=np.uint64)
+    )
+
+
+def unpack_loci(
+    keys: npt.NDArray[np.uint64],
+) -> tuple[npt.NDArray[np.uint32], npt.NDArray[np.uint32], npt.NDArray]:
+    """Get the starts, ends and name codes of packed loci"""
+    starts = (keys >> (SPAN_BITS + NAME_BITS)).astype(np.uint32)
+    spans = ((keys >> NAME_BITS) & MAX_SPAN).astype(np.uint32)
+    names = (keys & (2**NAME_BITS - 1)).astype(np.uint16)
+    return starts, starts + spans, names
+
+
+def key_starts(keys: npt.NDArray[np.uint64]) -> npt.NDArray[np.uint64]:
+    """Get the start positions of packed loci (without unpacking them)"""
+    return keys >> np.uint64(SPAN_BITS + NAME_BITS)
@@ -14,3 +14,26 @@ class BedMethylReadError(SquireError):
     """Exception for non-viable bedmethyl files being supplied"""
 
     pass
+
+
+class BedMethylLineError(BedMethylReadError):
+    """Exception for a malformed line within a chunk of a bedmethyl file
+
+    The line number is relative to the start of the chunk being parsed (0
+    being the first line), see `SampleWriter.locate` for the position within
+    the file.
+    """
+
+    def __init__(self, line: int, reason: str) -> None:
+        super().__init__(line, reason)
+        self.line = line
+        self.reason = reason
+
+    def __str__(self) -> str:
+        return f"line {self.line} of chunk: {self.reason}"
+
+
+class RegionsReadError(SquireError):
+    """Exception for non-viable regions (BED) files being supplied"""
+
+    pass
@@ -1,111 +1,434 @@
-import multiprocessing
-import warnings
-from multiprocessing import Pool
+from functools import partial
 from pathlib import Path
 
 import numpy as np
+import numpy.typing as npt
 import pandas as pd
-from scipy.stats import chi2_contingency
-from statsmodels.stats.proportion import proportions_ztest
+from scipy.stats import chi2, norm
 
-from squire.sorting import chromosome_sorter
+from squire.hdf5store import (
+    STATS_GROUP,
+    append_stats,
+    get_attributes,
+    get_chromosomes,
+    get_merged_row_count,
+    get_sample_names,
+    get_sorted_p_values_key,
+    get_stats_group,
+    get_stats_key,
+    get_table,
+    has_stats,
+    index_stats,
+    iter_row_chunks,
+    read_merged,
+    select_samples,
+    write_sorted_p_values,
+)
+from squire.parallel import SharedArray, WorkerPool
 from squire.types import (
-    CountArray,
-    GenomicLociGenerator,
-    GenomicLocus,
-    GenomicLocusWithPValue,
-    PValue,
+    CountMatrix,
+    LociBatchGenerator,
+    PValueArray,
+    RowRanges,
     StatsFunction,
 )
 
+COUNT_FIELDS = ["modifications", "read_depth"]
+# Each cached p-value takes 24 bytes (key, p-value and when it was used)
+P_VALUE_CACHE_SIZE = 1_000_000
+# Finding repeated rows costs about as much as testing them, so batches with
+# few repeats are tested directly (and memoization is tried again later)
+MAX_TESTED_FRACTION = 0.5
+MEMOIZATION_RETRY_INTERVAL = 10
+
 
 def generate_batch(
-    store: pd.HDFStore, chunk_size: int
-) -> GenomicLociGenerator:
-    """Generator function producing batches of merged data within hdf5 store"""
-    bedmethyls = sorted(
-        {
-            "_".join(col.split("_")[0:-1])
-            for col in store["merged_data"].columns
-            if "_modifications" in col
-        }
-    )
+    store: pd.HDFStore,
+    chromosome: str,
+    chunk_size: int,
+    row_ranges: RowRanges | None = None,
+    samples: list[str] | None = None,
+) -> LociBatchGenerator:
+    """Generator function producing batches of a chromosome's merged data
 
-    for chunk in store.select("merged_data", chunksize=chunk_size):
-        batch = []
-        for _, row in chunk.iterrows():
-            counts = np.array(
-                [row[f"{bedmethyl}_modifications"] for bedmethyl in bedmethyls]
-            )
-            read_depths = np.array(
-                [row[f"{bedmethyl}_read_depth"] for bedmethyl in bedmethyls]
-            )
+    Each batch is made up of the coordinates (start, end, name) of the loci
+    in the batch and two contiguous (loci x samples) matrices: the number of
+    modifications and the read depth for each sample. Only these columns are
+    read from the store.
 
-            batch.append(
-                (
-                    row.name,
-                    counts,
-                    read_depths,
-                )
-            )
-        yield batch
+    Parameters
+    ---
+    row_ranges: RowRanges | None
+        Only read these ranges of rows (see `find_rows`), every row is read
+        if None.
+    samples: list[str] | None
+        Only read these samples (in this order), every sample is read if
+        None.
+    """
+    samples = select_samples(store, samples)
+    if row_ranges is None:
+        row_ranges = [(0, get_merged_row_count(store, chromosome))]
+    for rows in iter_row_chunks(row_ranges, chunk_size):
+        chunk = read_merged(store, chromosome, rows, samples, COUNT_FIELDS)
+        yield (
+            chunk.index.to_frame(index=False).drop(columns="chr"),
+            *get_count_matrices(chunk, samples),
+        )
+
+
+def get_count_matrices(
+    chunk: pd.DataFrame, samples: list[str]
+) -> tuple[CountMatrix, CountMatrix]:
+    """Get the (loci x samples) modification and read depth matrices"""
+    return (
+        np.ascontiguousarray(
+            chunk[[f"{sample}_modifications" for sample in samples]],
+            dtype=np.int64,
+        ),
+        np.ascontiguousarray(
+            chunk[[f"{sample}_read_depth" for sample in samples]],
+            dtype=np.int64,
+        ),
+    )
 
 
 def two_proportion_z_test(
-    counts: CountArray, read_depths: CountArray
-) -> PValue:
-    """Wrapper for proportions_ztest
+    counts: CountMatrix, read_depths: CountMatrix
+) -> PValueArray:
+    """Vectorised two-proportion z-test over a block of loci
+
+    Each row of `counts`/`read_depths` (loci x 2 samples) is tested with the
+    pooled two-sided z-test used by statsmodels' `proportions_ztest`.
 
-    Handles scenarios that will break proportions_ztest, returning 1 instead
-    np.nan. A value of 1 makes more sense for a p_value.
+    Degenerate rows, where either sample has no reads or the pooled
+    proportion is 0 or 1 (so the standard error is 0), are given a p-value of
+    1 instead of np.nan. A value of 1 makes more sense for a p_value.
     """
-    valid_indexes = read_depths > 0
-    if sum(valid_indexes) < 2:
-        return 1
-    try:
-        _, p_value = proportions_ztest(counts, read_depths)
-        if np.isnan(p_value):
-            return 1
-        return p_value
-    except RuntimeWarning:
-        return 1
+    modifications = np.asarray(counts, dtype=np.float64)
+    depths = np.asarray(read_depths, dtype=np.float64)
+    total_depths = depths.sum(axis=1)
+    pooled_proportions = np.divide(
+        modifications.sum(axis=1),
+        total_depths,
+        out=np.zeros_like(total_depths),
+        where=total_depths > 0,
+    )
+    testable = (
+        (depths > 0).all(axis=1)
+        & (pooled_proportions > 0)
+        & (pooled_proportions < 1)
+    )
+
+    modifications = modifications[testable]
+    depths = depths[testable]
+    pooled_proportions = pooled_proportions[testable]
+    proportions = modifications / depths
+    standard_errors = np.sqrt(
+        pooled_proportions
+        * (1 - pooled_proportions)
+        * (1 / depths).sum(axis=1)
+    )
+    z_statistics = (proportions[:, 0] - proportions[:, 1]) / standard_errors
+
+    p_values = np.ones(len(testable), dtype=np.float64)
+    p_values[testable] = norm.sf(np.abs(z_statistics)) * 2
+    return p_values
 
 
 def chi_squared_contingency(
-    counts: CountArray, read_depths: CountArray
-) -> PValue:
-    """Wrapper for chi2_contigency
+    counts: CountMatrix, read_depths: CountMatrix
+) -> PValueArray:
+    """Vectorised chi squared test of independence over a block of loci
+
+    Each row of `counts`/`read_depths` (loci x samples) describes the 2xN
+    contingency table (modified, unmodified) that `chi2_contingency` would
+    be given for that locus. Samples with no reads are dropped from the table
+    of that row, so the degrees of freedom can differ between rows.
 
-    Returns 1 on failure and creates the contingency table to be used by
-    the function
+    Gives the same p-values as calling `chi2_contingency` row by row
+    (including Yates' correction when there is 1 degree of freedom). Rows
+    that would make `chi2_contingency` fail (fewer than 2 samples with reads
+    or an expected frequency of 0) are given a p-value of 1.
     """
-    valid_indexes = read_depths > 0
-    if sum(valid_indexes) < 2:
-        return 1
-    contingency_table = np.vstack(
-        [
-            counts[valid_indexes],
-            read_depths[valid_indexes] - counts[valid_indexes],
-        ]
+    modifications = np.asarray(counts, dtype=np.float64)
+    depths = np.asarray(read_depths, dtype=np.float64)
+    valid = depths > 0
+    degrees_of_freedom = valid.sum(axis=1) - 1
+
+    observed = np.where(
+        valid, np.stack([modifications, depths - modifications]), 0
+    )
+    row_totals = observed.sum(axis=2, keepdims=True)
+    grand_totals = depths.sum(axis=1)[:, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = row_totals * depths / grand_totals
+
+    testable = (
+        (degrees_of_freedom > 0)
+        & (row_totals > 0).all(axis=0)[:, 0]
+        & (observed >= 0).all(axis=(0, 2))
+    )
+
+    yates_rows = (degrees_of_freedom == 1)[:, np.newaxis]
+    difference = expected - observed
+    correction = np.sign(difference) * np.minimum(0.5, np.abs(difference))
+    observed = np.where(yates_rows, observed + correction, observed)
+
+    terms = np.divide(
+        (observed - expected) ** 2,
+        expected,
+        out=np.zeros_like(expected),
+        where=valid & (expected > 0),
+    )
+    statistic = terms.sum(axis=(0, 2))
+
+    p_values = np.ones(len(statistic), dtype=np.float64)
+    p_values[testable] = chi2.sf(
+        statistic[testable], degrees_of_freedom[testable]
     )
+    return p_values
+
+
+def select_stats_function(sample_count: int) -> StatsFunction:
+    """Choose the statistical test to use for a number of samples"""
+    if sample_count == 1:
+        raise ValueError("Not enough samples, no need to run SQUIRE")
+    elif sample_count == 2:
+        return two_proportion_z_test
+    return chi_squared_contingency
+
+
+def split_rows(n_rows: int, n_blocks: int) -> list[slice]:
+    """Split n_rows into (at most) n_blocks contiguous slices"""
+    block_size = max(1, -(-n_rows // n_blocks))
+    return [
+        slice(start, min(start + block_size, n_rows))
+        for start in range(0, n_rows, block_size)
+    ]
+
+
+def compute_shared_block(
+    stats_function: StatsFunction,
+    counts: SharedArray,
+    read_depths: SharedArray,
+    p_values: SharedArray,
+    rows: slice,
+) -> None:
+    """Helper function for process workers
+
+    Computes the p-values for a range of rows of the shared count/read depth
+    matrices, writing them into the shared p-value array.
+    """
     try:
-        _, p_value, _, _ = chi2_contingency(contingency_table)
-        return p_value  # type: ignore[reportReturnType]
-    except ValueError:
-        return 1
+        p_values.array[rows] = stats_function(
+            counts.array[rows], read_depths.array[rows]
+        )
+    finally:
+        for shared_array in (counts, read_depths, p_values):
+            shared_array.close()
 
 
-def process_row(
-    row: GenomicLocus, stats_function: StatsFunction
-) -> GenomicLocusWithPValue:
-    """Helper function for mulitprocessing map"""
-    id, counts, read_depths = row
-    p_value = stats_function(counts, read_depths)
-    return (*id, p_value)
+def apply_stats_function(
+    stats_function: StatsFunction,
+    counts: CountMatrix,
+    read_depths: CountMatrix,
+    workers: WorkerPool,
+) -> PValueArray:
+    """Apply a statistical test to a batch, split into blocks across workers
+
+    Thread workers are given views of the matrices directly. For process
+    workers the matrices are placed into shared memory and each worker is
+    only sent the rows to compute, writing into a shared p-value array. This
+    avoids pickling the data to (and p-values back from) each worker.
+    """
+    blocks = split_rows(len(counts), workers.jobs * 4)
+    if workers.backend == "thread":
+        return np.concatenate(
+            list(
+                workers.executor.map(
+                    stats_function,
+                    [counts[block] for block in blocks],
+                    [read_depths[block] for block in blocks],
+                )
+            )
+        )
+
+    with (
+        SharedArray.from_array(counts) as shared_counts,
+        SharedArray.from_array(read_depths) as shared_read_depths,
+        SharedArray((len(counts),), np.float64) as shared_p_values,
+    ):
+        list(
+            workers.executor.map(
+                partial(
+                    compute_shared_block,
+                    stats_function,
+                    shared_counts,
+                    shared_read_depths,
+                    shared_p_values,
+                ),
+                blocks,
+            )
+        )
+        return shared_p_values.array.copy()
+
+
+class PValueCache:
+    """Least recently used cache of p-values by (counts, read depths) rows
+
+    Loci with the same modification counts and read depths in every sample
+    (e.g. low coverage or fully (un)modified loci) have the same p-value.
+    Rows are packed into a single uint64 key (see `get_keys`) and the cache
+    is kept as arrays sorted by key, so that a whole batch is looked up at
+    once (np.searchsorted). Once full, the least recently used keys are
+    dropped.
+
+    The cache only holds p-values of one statistical test and sample set.
+    """
+
+    def __init__(
+        self, sample_count: int, max_size: int = P_VALUE_CACHE_SIZE
+    ) -> None:
+        self.value_bits = 64 // (2 * sample_count)
+        self.max_size = max_size
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.p_values = np.empty(0, dtype=np.float64)
+        self.last_used = np.empty(0, dtype=np.int64)
+        self.batch = 0
+        self.tested_fraction = 0.0
+        self.batches_skipped = 0
+
+    def skip_batch(self) -> bool:
+        """Whether to test the next batch directly, without memoization
+
+        This is the case if most rows of the last memoized batch still had
+        to be tested, until MEMOIZATION_RETRY_INTERVAL batches are skipped.
+        """
+        if (
+            self.tested_fraction > MAX_TESTED_FRACTION
+            and self.batches_skipped < MEMOIZATION_RETRY_INTERVAL
+        ):
+            self.batches_skipped += 1
+            return True
+        self.batches_skipped = 0
+        return False
+
+    def get_keys(
+        self, counts: CountMatrix, read_depths: CountMatrix
+    ) -> tuple[npt.NDArray[np.uint64], npt.NDArray[np.bool_]]:
+        """Pack each row's counts and read depths into a key
+
+        Each count and read depth is given an equal share of the 64 bits.
+        Rows with a value that doesn't fit (high coverage loci, which are
+        rarely repeated) are not packed. Returns the keys of the packable
+        rows and which rows are packable.
+        """
+        limit = 2**self.value_bits
+        packable = (
+            (counts >= 0).all(axis=1)
+            & (counts < limit).all(axis=1)
+            & (read_depths >= 0).all(axis=1)
+            & (read_depths < limit).all(axis=1)
+        )
+        keys = np.zeros(len(counts), dtype=np.uint64)
+        for column in (*counts.T, *read_depths.T):
+            keys <<= np.uint64(self.value_bits)
+            keys |= column.astype(np.uint64)
+        if not packable.all():
+            keys = keys[packable]
+        return keys, packable
+
+    def get(
+        self, keys: npt.NDArray[np.uint64]
+    ) -> tuple[PValueArray, npt.NDArray[np.bool_]]:
+        """Get the cached p-values of (unique) keys and which were cached"""
+        self.batch += 1
+        positions = np.searchsorted(self.keys, keys)
+        cached = positions < len(self.keys)
+        cached[cached] = self.keys[positions[cached]] == keys[cached]
+        p_values = np.empty(len(keys), dtype=np.float64)
+        p_values[cached] = self.p_values[positions[cached]]
+        self.last_used[positions[cached]] = self.batch
+        return p_values, cached
+
+    def add(self, keys: npt.NDArray[np.uint64], p_values: PValueArray) -> None:
+        """Cache the p-values of (unique, uncached) keys
+
+        If the cache is full, the least recently used keys are dropped.
+        """
+        positions = np.searchsorted(self.keys, keys)
+        self.keys = np.insert(self.keys, positions, keys)
+        self.p_values = np.insert(self.p_values, positions, p_values)
+        self.last_used = np.insert(self.last_used, positions, self.batch)
+        if len(self.keys) > self.max_size:
+            # A mask keeps the keys in order, unlike indexing with the
+            # partition itself
+            kept = np.zeros(len(self.keys), dtype=np.bool_)
+            kept[
+                np.argpartition(-self.last_used, self.max_size - 1)[
+                    : self.max_size
+                ]
+            ] = True
+            self.keys = self.keys[kept]
+            self.p_values = self.p_values[kept]
+            self.last_used = self.last_used[kept]
+
+
+def apply_memoized_stats_function(
+    stats_function: StatsFunction,
+    counts: CountMatrix,
+    read_depths: CountMatrix,
+    workers: WorkerPool,
+    cache: PValueCache,
+) -> PValueArray:
+    """Apply a statistical test to a batch, once per repeated row
+
+    Rows with the same counts and read depths (see `PValueCache.get_keys`)
+    are only tested once, and rows already in the cache are not tested at
+    all. The test (see `apply_stats_function`) is applied to the remaining
+    unique rows and the rows that can't be cached, then the p-values are
+    scattered back to every row.
+
+    Batches with few repeated rows are tested directly (see
+    `PValueCache.skip_batch`).
+    """
+    if len(counts) == 0:
+        return np.empty(0, dtype=np.float64)
+    if cache.skip_batch():
+        return apply_stats_function(
+            stats_function, counts, read_depths, workers
+        )
+    keys, packable = cache.get_keys(counts, read_depths)
+    unique_keys = np.unique(keys)
+    inverse = np.searchsorted(unique_keys, keys)
+    # Any row with a key can stand in for the others
+    key_rows = np.empty(len(unique_keys), dtype=np.intp)
+    key_rows[inverse] = np.flatnonzero(packable)
+    unique_p_values, cached = cache.get(unique_keys)
+    new_rows = key_rows[~cached]
+    rows = np.concatenate([new_rows, np.flatnonzero(~packable)])
+    cache.tested_fraction = len(rows) / len(counts)
+    computed = (
+        apply_stats_function(
+            stats_function, counts[rows], read_depths[rows], workers
+        )
+        if len(rows) > 0
+        else np.empty(0, dtype=np.float64)
+    )
+    unique_p_values[~cached] = computed[: len(new_rows)]
+    cache.add(unique_keys[~cached], computed[: len(new_rows)])
+
+    p_values = np.empty(len(counts), dtype=np.float64)
+    p_values[packable] = unique_p_values[inverse]
+    p_values[~packable] = computed[len(new_rows) :]
+    return p_values
 
 
 def compute_p_values(
-    hdf_path: Path, n_processes: int | None = None, chunk_size: int = 100_000
+    hdf_path: Path,
+    workers: WorkerPool,
+    chunk_size: int = 100_000,
+    samples: list[str] | None = None,
 ) -> None:
     """Main function for computing p-values for generating cpg lists
 
@@ -120,59 +443,125 @@ def compute_p_values(
     is expected to be normally distributed.
 
     If there are two samples only, a two-proportion z-test is used.
-    If there are more than two samples, a chi squared test is used.
+    If there are more than two samples, a chi squared test is used. The test
+    is only applied once for loci with the same counts and read depths (see
+    `apply_memoized_stats_function`).
 
-    This function creates a pandas dataframe in the given hdf5 store with
-    the columns:
-        - chromosome
+    The p-values of each chromosome are stored in stats/<chromosome>, a
+    table with the columns:
         - start
         - end
         - name(m/h)
         - p_value from statistical test
-    """
-    if n_processes is None:
-        n_processes = multiprocessing.cpu_count() - 1 or 1
 
-    with pd.HDFStore(hdf_path, mode="r") as store:
-        sample_count = sum(
-            1
-            for col in store["merged_data"].columns
-            if "_modifications" in col
-        )
-
-        if sample_count == 1:
-            raise ValueError("Not enough samples, no need to run SQUIRE")
-        elif sample_count == 2:
-            stats_function = two_proportion_z_test
-        else:
-            stats_function = chi_squared_contingency
+    Any existing p-values are replaced, and the samples that the p-values
+    were computed against are recorded in the attributes of the stats group.
+    Every p-value is also stored in ascending order (see
+    `write_sorted_p_values`) for `report`.
 
+    Parameters
+    ---
+    workers: WorkerPool
+        Worker pool (shared across the whole run) that the statistical tests
+        are run in. Each chunk is split into blocks of rows for the workers.
+    samples: list[str] | None
+        Compute the p-values against a subset of the samples, only these
+        samples are read. The p-values are stored in their own stats group
+        (see `get_stats_group`) alongside those of every sample.
+    """
     with pd.HDFStore(hdf_path, mode="r+") as store:
-        warnings.filterwarnings("error")
-        for batch in generate_batch(store, chunk_size):
-            with Pool(n_processes) as pool:
-                from functools import partial
+        samples = select_samples(store, samples)
+        stats_function = select_stats_function(len(samples))
+        group = get_stats_group(store, samples)
+        cache = PValueCache(len(samples))
+        for key in (group, get_sorted_p_values_key(group)):
+            if key in store:
+                store.remove(key)
 
-                process_function = partial(
-                    process_row, stats_function=stats_function
+        # The merged data is already in genomic order, so no sort is needed
+        for chromosome in get_chromosomes(store):
+            for coordinates, counts, read_depths in generate_batch(
+                store, chromosome, chunk_size, samples=samples
+            ):
+                p_values = apply_memoized_stats_function(
+                    stats_function, counts, read_depths, workers, cache
                 )
-                results = pool.map(
-                    process_function,
-                    batch,
-                    chunksize=max(1, len(batch) // (n_processes * 4)),
+                append_stats(
+                    store,
+                    get_stats_key(chromosome, group),
+                    coordinates,
+                    p_values,
                 )
+            index_stats(store, get_stats_key(chromosome, group))
+        get_attributes(store, group).samples = samples
+        write_sorted_p_values(store, group)
 
-            stats_chunk = pd.DataFrame(
-                results,
-                columns=["chr", "start", "end", "name", "p_value"],  # type: ignore[arg-type]
-            ).sort_values(
-                ["chr", "start", "end", "name"],
-                key=lambda x: x.map(chromosome_sorter)
-                if x.name == "chr"
-                else x,
-            )
 
-            store.append(
-                "stats", stats_chunk, format="table", data_columns=True
+def update_p_values(
+    hdf_path: Path,
+    workers: WorkerPool,
+    chunk_size: int = 100_000,
+) -> None:
+    """Compute the p-values that are missing (NaN) after an `add`
+
+    See `add_partition` for which p-values are kept after an `add`. Only the
+    chunks of stats that have missing p-values are read (along with the
+    matching rows of the merged data), and only the missing p-values are
+    computed and written back into the stats tables, in place.
+
+    If the statistical test changes with the new sample set (2 samples use a
+    z-test, more use a chi squared test), or there are no p-values to keep,
+    all p-values are computed again (see `compute_p_values`).
+
+    Parameters
+    ---
+    workers: WorkerPool
+        Worker pool (shared across the whole run) that the statistical tests
+        are run in.
+    """
+    with pd.HDFStore(hdf_path, mode="r") as store:
+        samples = get_sample_names(store)
+        stats_function = select_stats_function(len(samples))
+        up_to_date = (
+            has_stats(store)
+            and select_stats_function(
+                len(get_attributes(store, STATS_GROUP).samples)
             )
-        warnings.resetwarnings()
+            is stats_function
+        )
+    if not up_to_date:
+        compute_p_values(hdf_path, workers, chunk_size)
+        return
+
+    cache = PValueCache(len(samples))
+    with pd.HDFStore(hdf_path, mode="r+") as store:
+        for chromosome in get_chromosomes(store):
+            stats_table = get_table(store, get_stats_key(chromosome))
+            row_count = int(stats_table.nrows)
+            for start in range(0, row_count, chunk_size):
+                stop = min(start + chunk_size, row_count)
+                p_values = stats_table.read(start, stop, field="p_value")
+                missing = np.isnan(p_values)
+                if not missing.any():
+                    continue
+                counts, read_depths = get_count_matrices(
+                    read_merged(
+                        store,
+                        chromosome,
+                        slice(start, stop),
+                        samples,
+                        COUNT_FIELDS,
+                    ).loc[missing],
+                    samples,
+                )
+                p_values[missing] = apply_memoized_stats_function(
+                    stats_function, counts, read_depths, workers, cache
+                )
+                stats_table.modify_column(
+                    start,
+                    stop,
+                    column=p_values,  # type: ignore[arg-type]
+                    colname="p_value",
+                )
+        get_attributes(store, STATS_GROUP).samples = samples
+        write_sorted_p_values(store)
@@ -2,10 +2,13 @@ import argparse
 from collections.abc import Callable, Generator
 from dataclasses import dataclass, field, fields
 from pathlib import Path
-from typing import cast
+from typing import Literal, cast
 
 import numpy as np
 import numpy.typing as npt
+import pandas as pd
+
+Backend = Literal["process", "thread"]
 
 
 # ------------------------
@@ -24,6 +27,11 @@ class SharedArgs:
 class CreateArgs(SharedArgs):
     """Arguments for the 'create' subcommand"""
 
+    jobs: int
+    backend: Backend
+    chunk_size: int
+    chromosomes: list[str] | None = None
+    shard: tuple[int, int] | None = None
     bedmethyl_list: list[Path] | None = None
     file: Path | None = None
 
@@ -33,14 +41,26 @@ class ReferenceArgs(SharedArgs):
     """Arguments for the 'reference' subcommand"""
 
     out_path: Path
+    bgzip: bool
+    jobs: int
+    backend: Backend
+    chunk_size: int
+    regions: Path | None = None
+    chromosomes: list[str] | None = None
+    samples: list[str] | None = None
 
 
 @dataclass
 class CpGListArgs(SharedArgs):
     """Arguments for the 'cpglist' subcommand"""
 
-    out_path: Path
-    threshold: float = 1e-10
+    out_paths: list[Path]
+    bgzip: bool = False
+    thresholds: list[float] = field(default_factory=lambda: [1e-10])
+    top: int | None = None
+    regions: Path | None = None
+    chromosomes: list[str] | None = None
+    samples: list[str] | None = None
 
 
 @dataclass
@@ -51,9 +71,36 @@ class ReportArgs(SharedArgs):
     thresholds: list[float] = field(
         default_factory=lambda: [1e-1, 1e-2, 1e-5, 1e-10, 1e-20]
     )
+    regions: Path | None = None
+    chromosomes: list[str] | None = None
+    samples: list[str] | None = None
+
+
+@dataclass
+class StatsArgs(SharedArgs):
+    """Arguments for the 'stats' subcommand"""
+
+    jobs: int
+    backend: Backend
+    chunk_size: int
+    samples: list[str] | None = None
+
 
+@dataclass
+class MergeShardsArgs(SharedArgs):
+    """Arguments for the 'merge-shards' subcommand"""
+
+    shards: list[Path]
 
-SquireArgs = CreateArgs | ReferenceArgs | CpGListArgs | ReportArgs
+
+SquireArgs = (
+    CreateArgs
+    | ReferenceArgs
+    | CpGListArgs
+    | ReportArgs
+    | StatsArgs
+    | MergeShardsArgs
+)
 
 
 def convert_to_squire_args(args: argparse.Namespace) -> SquireArgs:
@@ -66,6 +113,8 @@ def convert_to_squire_args(args: argparse.Namespace) -> SquireArgs:
         "reference": ReferenceArgs,
         "cpglist": CpGListArgs,
         "report": ReportArgs,
+        "stats": StatsArgs,
+        "merge-shards": MergeShardsArgs,
     }
 
     dataclass_type = command_map[args.command]
@@ -78,18 +127,17 @@ def convert_to_squire_args(args: argparse.Namespace) -> SquireArgs:
 # ------------------------
 # STATISTICS TYPES
 # ------------------------
-GenomicLocus = tuple[
-    tuple[str, np.uint32, np.uint32, str],
-    npt.NDArray[np.int64],
-    npt.NDArray[np.int64],
-]
-GenomicLociGenerator = Generator[
-    list[GenomicLocus],
-    None,
-    None,
-]
-
-CountArray = npt.NDArray[np.int64]
-PValue = npt.NDArray[np.float64] | float | int
-StatsFunction = Callable[[CountArray, CountArray], PValue]
-GenomicLocusWithPValue = tuple[str, np.uint32, np.uint32, str, PValue]
+CountMatrix = npt.NDArray[np.int64]
+PValueArray = npt.NDArray[np.float64]
+StatsFunction = Callable[[CountMatrix, CountMatrix], PValueArray]
+LociBatch = tuple[pd.DataFrame, CountMatrix, CountMatrix]
+LociBatchGenerator = Generator[LociBatch, None, None]
+
+
+# ------------------------
+# REGION TYPES
+# ------------------------
+# The (0-based, half open) intervals of each chromosome
+Regions = dict[str, list[tuple[int, int]]]
+# Ranges of rows, [start, stop), of a chromosome's tables
+RowRanges = list[tuple[int, int]]
@@ -0,0 +1,120 @@
+import gzip
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from squire.bedmethyl import split_bedmethyl
+from squire.bgzf import (
+    BGZF_BLOCK_DATA,
+    BgzfWriter,
+    compress_lines,
+    find_index,
+    is_bgzf,
+    read_index,
+)
+
+CHROMOSOMES = ["chr1", "chr2", "chrX"]
+
+
+def make_loci(
+    chromosome: str, count: int, seed: int
+) -> tuple[bytes, np.ndarray, np.ndarray]:
+    """Sorted loci (of varying length) as the lines of a BED file"""
+    rng = np.random.default_rng(seed)
+    starts = np.sort(rng.integers(0, 5_000_000, count))
+    ends = starts + rng.integers(1, 50, count)
+    lines = "".join(
+        f"{chromosome}\t{start}\t{end}\tm\t{rng.integers(0, 100)}.000\n"
+        for start, end in zip(starts.tolist(), ends.tolist(), strict=True)
+    )
+    return lines.encode(), starts, ends
+
+
+@pytest.fixture
+def bgzf_file(tmp_path: Path) -> tuple[Path, dict[str, list[bytes]]]:
+    """A BGZF file (and index) of several chromosomes, written in chunks
+
+    Returns the path and the lines of each chromosome.
+    """
+    file_path = tmp_path / "loci.bed.gz"
+    lines: dict[str, list[bytes]] = {}
+    with open(file_path, "wb") as out_file:
+        writer = BgzfWriter(out_file, tmp_path / "loci.bed.gz.tbi")
+        for seed, chromosome in enumerate(CHROMOSOMES):
+            chromosome_lines, starts, ends = make_loci(
+                chromosome, 20_000, seed
+            )
+            lines[chromosome] = chromosome_lines.splitlines(keepends=True)
+            # Uneven chunks, so that lines cross block and chunk boundaries
+            for first, last in [(0, 7_000), (7_000, 7_001), (7_001, 20_000)]:
+                writer.write(
+                    compress_lines(
+                        b"".join(lines[chromosome][first:last]),
+                        chromosome,
+                        starts[first:last],
+                        ends[first:last],
+                    )
+                )
+        writer.finish()
+    return file_path, lines
+
+
+def test_round_trips_through_gzip(
+    bgzf_file: tuple[Path, dict[str, list[bytes]]],
+) -> None:
+    file_path, lines = bgzf_file
+    assert is_bgzf(file_path)
+    assert gzip.decompress(file_path.read_bytes()) == b"".join(
+        b"".join(lines[chromosome]) for chromosome in CHROMOSOMES
+    )
+
+
+def test_index_finds_each_chromosome(
+    bgzf_file: tuple[Path, dict[str, list[bytes]]],
+) -> None:
+    file_path, lines = bgzf_file
+    assert find_index(file_path) is not None
+    assert list(read_index(file_path.with_suffix(".gz.tbi"))) == CHROMOSOMES
+    for chromosome in CHROMOSOMES:
+        chunks = [
+            chunk.read()
+            for chunk, _ in split_bedmethyl(
+                file_path, 2 * BGZF_BLOCK_DATA, [chromosome]
+            )
+        ]
+        read = b"".join(chunks).splitlines(keepends=True)
+        assert [
+            line for line in read if line.startswith(chromosome.encode())
+        ] == lines[chromosome]
+        # Only the blocks of the chromosome (and its neighbours) are read
+        assert len(read) < sum(len(lines[other]) for other in CHROMOSOMES)
+
+
+def test_tabix_queries_match_the_lines(
+    bgzf_file: tuple[Path, dict[str, list[bytes]]],
+) -> None:
+    pysam = pytest.importorskip("pysam")
+    file_path, lines = bgzf_file
+    rng = np.random.default_rng(0)
+    with pysam.TabixFile(str(file_path)) as tabix_file:
+        for chromosome in CHROMOSOMES:
+            fields = [line.split(b"\t") for line in lines[chromosome]]
+            starts = np.array([int(field[1]) for field in fields])
+            ends = np.array([int(field[2]) for field in fields])
+            for start in rng.integers(0, 5_000_000, 20).tolist():
+                end = start + int(rng.integers(1, 200_000))
+                overlapping = (starts < end) & (ends > start)
+                assert list(tabix_file.fetch(chromosome, start, end)) == [
+                    lines[chromosome][row].decode().rstrip("\n")
+                    for row in np.flatnonzero(overlapping)
+                ]
+
+
+def test_large_chunks_are_split_into_blocks() -> None:
+    lines, starts, ends = make_loci("chr1", 10_000, 0)
+    chunk = compress_lines(lines, "chr1", starts, ends)
+    block_sizes = [uncompressed for _, uncompressed in chunk.block_sizes]
+    assert max(block_sizes) == BGZF_BLOCK_DATA
+    assert sum(block_sizes) == len(lines)
+    assert gzip.decompress(chunk.data) == lines
@@ -0,0 +1,88 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from squire.hdf5store import (
+    add_files_to_hdf_store,
+    create_merged_dataset,
+    get_coordinates_key,
+    get_table,
+)
+from squire.parallel import create_worker_pool
+from squire.regions import find_rows, merge_intervals, read_regions
+
+
+def write_bedmethyl(file_path: Path, seed: int) -> None:
+    """Write a bedmethyl file of sorted loci with varying lengths"""
+    rng = np.random.default_rng(seed)
+    lines = []
+    for chromosome in ("chr1", "chr2"):
+        starts = np.unique(rng.integers(0, 100_000, 2_000))
+        spans = rng.choice([1, 1, 1, 2, 5, 30], len(starts))
+        for start, span in zip(starts.tolist(), spans.tolist(), strict=True):
+            depth = int(rng.integers(1, 30))
+            modified = int(rng.integers(0, depth + 1))
+            lines.append(
+                f"{chromosome}\t{start}\t{start + span}\tm\t{depth}\t+\t"
+                f"{start}\t{start + span}\t255,0,0\t{depth} "
+                f"{100 * modified / depth:.2f} {modified} "
+                f"{depth - modified} 0 0 0 0 0\n"
+            )
+    file_path.write_text("".join(lines))
+
+
+@pytest.fixture(scope="module")
+def hdf_path(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    directory = tmp_path_factory.mktemp("regions")
+    file_paths = [directory / f"{sample}.bed" for sample in ("a", "b")]
+    for seed, file_path in enumerate(file_paths):
+        write_bedmethyl(file_path, seed)
+    hdf_path = directory / "squire.h5"
+    with create_worker_pool(2, "thread") as workers:
+        add_files_to_hdf_store(file_paths, hdf_path, workers)
+        create_merged_dataset(hdf_path, workers)
+    return hdf_path
+
+
+def test_merge_intervals() -> None:
+    assert merge_intervals([(10, 20), (0, 5), (5, 8), (15, 30), (40, 40)]) == [
+        (0, 8),
+        (10, 30),
+    ]
+
+
+def test_read_regions(tmp_path: Path) -> None:
+    regions_path = tmp_path / "regions.bed"
+    regions_path.write_text(
+        "track name=panel\nchr2\t50\t60\nchr1\t0\t10\tname\nchr2\t55\t70\n"
+    )
+    assert read_regions(regions_path) == {
+        "chr2": [(50, 70)],
+        "chr1": [(0, 10)],
+    }
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_find_rows_matches_a_full_scan(hdf_path: Path, seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    with pd.HDFStore(hdf_path, mode="r") as store:
+        for chromosome in ("chr1", "chr2"):
+            loci = get_table(store, get_coordinates_key(chromosome)).read()
+            intervals = merge_intervals(
+                [
+                    (start, start + int(rng.integers(0, 2_000)))
+                    for start in rng.integers(0, 110_000, 50).tolist()
+                ]
+            )
+            overlapping = np.zeros(len(loci), dtype=bool)
+            for start, end in intervals:
+                overlapping |= (loci["start"] < end) & (loci["end"] > start)
+            rows = np.concatenate(
+                [
+                    np.arange(first, last)
+                    for first, last in find_rows(store, chromosome, intervals)
+                ]
+            )
+            np.testing.assert_array_equal(rows, np.flatnonzero(overlapping))
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from scipy.stats import chi2_contingency
+
+from squire.parallel import create_worker_pool
+from squire.stats import (
+    apply_stats_function,
+    chi_squared_contingency,
+    two_proportion_z_test,
+)
+from squire.types import CountMatrix
+
+
+def make_counts(
+    loci: int, samples: int, seed: int = 0
+) -> tuple[CountMatrix, CountMatrix]:
+    """Random modification counts and read depths, including edge cases
+
+    Some samples have no reads, and some loci have no (or only) modified
+    reads, so that every degenerate case of the tests is covered.
+    """
+    rng = np.random.default_rng(seed)
+    read_depths = rng.integers(0, 40, (loci, samples))
+    read_depths[rng.random((loci, samples)) < 0.2] = 0
+    modifications = rng.binomial(read_depths, rng.random((loci, 1)))
+    modifications[: loci // 10] = 0
+    modifications[loci // 10 : loci // 5] = read_depths[loci // 10 : loci // 5]
+    return modifications, read_depths
+
+
+def expected_chi_squared(
+    modifications: CountMatrix, read_depths: CountMatrix
+) -> list[float]:
+    """The p-values of scipy's chi2_contingency (1 where it can't be used)"""
+    p_values = []
+    for counts, depths in zip(modifications, read_depths, strict=True):
+        with_reads = depths > 0
+        table = np.array(
+            [counts[with_reads], (depths - counts)[with_reads]]
+        )
+        if with_reads.sum() < 2 or (table.sum(axis=1) == 0).any():
+            p_values.append(1.0)
+        else:
+            p_values.append(chi2_contingency(table)[1])
+    return p_values
+
+
+@pytest.mark.parametrize("samples", [2, 3, 6])
+def test_chi_squared_matches_scipy(samples: int) -> None:
+    modifications, read_depths = make_counts(500, samples)
+    np.testing.assert_allclose(
+        chi_squared_contingency(modifications, read_depths),
+        expected_chi_squared(modifications, read_depths),
+        rtol=1e-10,
+    )
+
+
+def test_z_test_matches_statsmodels() -> None:
+    proportion = pytest.importorskip("statsmodels.stats.proportion")
+    modifications, read_depths = make_counts(500, 2)
+    expected = []
+    for counts, depths in zip(modifications, read_depths, strict=True):
+        pooled = counts.sum() / max(depths.sum(), 1)
+        if (depths == 0).any() or pooled in (0, 1):
+            expected.append(1.0)
+        else:
+            expected.append(proportion.proportions_ztest(counts, depths)[1])
+    np.testing.assert_allclose(
+        two_proportion_z_test(modifications, read_depths),
+        expected,
+        rtol=1e-10,
+    )
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_workers_give_the_same_p_values(backend: str) -> None:
+    modifications, read_depths = make_counts(1_003, 4)
+    with create_worker_pool(3, backend) as workers:  # type: ignore[arg-type]
+        p_values = apply_stats_function(
+            chi_squared_contingency, modifications, read_depths, workers
+        )
+    np.testing.assert_array_equal(
+        p_values, chi_squared_contingency(modifications, read_depths)
+    )